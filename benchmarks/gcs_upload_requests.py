@@ -0,0 +1,132 @@
+"""Counts the GCS API requests each GCSFileManager upload mode makes.
+
+Runs against an in-memory fake of the GCS JSON API, so no credentials or network
+are needed:
+
+    LOCAL_TIME_ZONE=UTC python benchmarks/gcs_upload_requests.py
+"""
+import collections
+import json
+import logging
+import re
+import urllib.parse
+
+import requests
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import storage
+
+from teamster.common.resources.google import GCSFileManager
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class FakeGCS(object):
+    """Answers the handful of JSON API calls GCSFileManager makes, counting each
+    one. Stands in for `Client._http`."""
+
+    is_mtls = False
+
+    def __init__(self):
+        self.objects = {}
+        self.requests = collections.Counter()
+
+    def _response(self, status_code, body=None):
+        response = requests.Response()
+        response.status_code = status_code
+        response.headers["Content-Type"] = "application/json"
+        response._content = json.dumps(body or {}).encode("utf-8")
+        return response
+
+    def _resource(self, bucket, name):
+        return {
+            "bucket": bucket,
+            "name": name,
+            "generation": "1",
+            "size": str(len(self.objects[(bucket, name)])),
+        }
+
+    def request(self, method, url, data=None, headers=None, **kwargs):
+        parsed = urllib.parse.urlparse(url)
+        params = urllib.parse.parse_qs(parsed.query)
+        path = urllib.parse.unquote(parsed.path)
+
+        match = re.search(r"/b/([^/]+)/o(?:/(.+))?$", path)
+        bucket, name = match.group(1), match.group(2)
+
+        if method == "POST" and "/upload/" in path:
+            self.requests["upload"] += 1
+
+            name = re.search(rb'"name": "([^"]+)"', data).group(1).decode("utf-8")
+            if params.get("ifGenerationMatch") == ["0"] and (
+                (bucket, name) in self.objects
+            ):
+                return self._response(412)
+
+            self.objects[(bucket, name)] = data
+            return self._response(200, self._resource(bucket, name))
+        elif method == "GET" and name is None:
+            self.requests["list"] += 1
+
+            prefix = params.get("prefix", [""])[0]
+            max_results = int(params.get("maxResults", [0])[0]) or None
+            items = [
+                self._resource(b, n)
+                for b, n in sorted(self.objects)
+                if b == bucket and n.startswith(prefix)
+            ][:max_results]
+            return self._response(200, {"items": items})
+        elif method == "GET":
+            self.requests["get"] += 1
+
+            if (bucket, name) not in self.objects:
+                return self._response(404)
+            return self._response(200, self._resource(bucket, name))
+        elif method == "DELETE":
+            self.requests["delete"] += 1
+
+            self.objects.pop((bucket, name), None)
+            return self._response(204)
+
+        raise NotImplementedError(f"{method} {url}")
+
+
+def count_requests(mode, n_uploads):
+    fake_gcs = FakeGCS()
+    client = storage.Client(
+        project="benchmark", credentials=AnonymousCredentials(), _http=fake_gcs
+    )
+    file_manager = GCSFileManager(
+        client=client,
+        gcs_bucket="bucket",
+        gcs_base_key="benchmark",
+        logger=logger,
+        upload_mode=mode,
+    )
+
+    # the first upload creates the object, the rest replace it
+    file_manager.upload_from_string(obj=b"page", file_key="table/page.json.gz")
+    fake_gcs.requests.clear()
+
+    for _ in range(n_uploads):
+        file_manager.upload_from_string(obj=b"page", file_key="table/page.json.gz")
+
+    return fake_gcs.requests
+
+
+def main():
+    n_uploads = 100
+
+    print(f"GCS requests per upload of an existing key ({n_uploads} uploads)")
+    for mode in ["replace", "overwrite"]:
+        requests_by_type = count_requests(mode=mode, n_uploads=n_uploads)
+        breakdown = ", ".join(f"{k}={v}" for k, v in sorted(requests_by_type.items()))
+
+        print(
+            f"{mode:>9}: {sum(requests_by_type.values()) / n_uploads:g} "
+            f"({breakdown})"
+        )
+
+
+if __name__ == "__main__":
+    main()
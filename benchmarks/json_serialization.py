@@ -0,0 +1,84 @@
+"""Compares rows/sec serializing extract pages with `json.dumps` and
+`CustomJSONEncoder` (before) against orjson via `json_dumps` (after).
+
+Rows are built in memory, so no credentials or network are needed:
+
+    LOCAL_TIME_ZONE=UTC python benchmarks/json_serialization.py
+"""
+import datetime
+import decimal
+import json
+import time
+
+from teamster.common.utils import CustomJSONEncoder, json_dumps
+
+
+def make_rows(n_rows, typed):
+    """PowerSchool pages hold strings, numbers and nulls. SQL cursor rows also
+    hold dates, datetimes and decimals, which go through the default hook."""
+    rows = []
+    for i in range(n_rows):
+        row = {
+            "id": i,
+            "dcid": 100000 + i,
+            "student_number": str(300000 + i),
+            "lastfirst": f"Lastname{i}, Firstname{i}",
+            "grade_level": i % 13,
+            "gpa": (i % 400) / 100,
+            "enroll_status": 0,
+            "home_room": None if i % 7 else "101",
+        }
+        if typed:
+            row.update(
+                {
+                    "dob": datetime.date(2010, 1, 1)
+                    + datetime.timedelta(days=i % 3650),
+                    "whenmodified": datetime.datetime(2022, 7, 1, 8, 30)
+                    + datetime.timedelta(seconds=i),
+                    "credit_hours": decimal.Decimal(i % 10) / 4,
+                }
+            )
+        rows.append(row)
+
+    return rows
+
+
+def before(rows):
+    return json.dumps(obj=rows, cls=CustomJSONEncoder).encode("utf-8")
+
+
+def after(rows):
+    return json_dumps(rows)
+
+
+def rows_per_second(dumps, rows, repeat=5):
+    # best of `repeat`, to leave out GC pauses and warm-up
+    best = min(timed(dumps, rows) for _ in range(repeat))
+    return len(rows) / best
+
+
+def timed(dumps, rows):
+    start = time.perf_counter()
+    dumps(rows)
+    return time.perf_counter() - start
+
+
+def main():
+    n_rows = 100000
+
+    print(f"rows/sec serializing one page of {n_rows} rows")
+    for label, typed in [("powerschool", False), ("sql", True)]:
+        rows = make_rows(n_rows=n_rows, typed=typed)
+        assert json.loads(before(rows)) == json.loads(after(rows))
+
+        before_rate = rows_per_second(before, rows)
+        after_rate = rows_per_second(after, rows)
+
+        print(
+            f"{label:>11}: json {before_rate:,.0f}, orjson {after_rate:,.0f} "
+            f"({after_rate / before_rate:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,9 @@ from dagster import graph
 
 from teamster.common.ops.datagun import (
     compose_queries,
+    extract_batch,
     extract,
+    extract_stream,
     load_destination,
     transform,
 )
@@ -26,3 +28,25 @@ def run_queries():
     transformed = dynamic_query.map(execute_query)
 
     transformed.map(load_destination)
+
+
+@graph
+def stream_queries():
+    # parse queries from run config file (./teamster/local/config/datagun/query-*.yaml)
+    dynamic_query = compose_queries()
+
+    # extract, encode and upload each query in one step, passing only file handles
+    transformed = dynamic_query.map(extract_stream)
+
+    transformed.map(load_destination)
+
+
+@graph
+def run_queries_batch():
+    # parse queries from run config file (./teamster/local/config/datagun/query-*.yaml)
+    dynamic_query = compose_queries()
+
+    # export every query from one step, with a cap on concurrent DB sessions
+    transformed = extract_batch(dynamic_query.collect())
+
+    transformed.map(load_destination)
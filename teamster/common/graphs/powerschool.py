@@ -1,43 +1,116 @@
 from dagster import graph
 
 from teamster.common.ops.powerschool import (
+    compact_files,
     compose_queries,
     compose_resyncs,
     compose_tables,
     filter_queries,
     get_count,
     get_data,
+    get_data_batch,
+    get_data_planned,
+    plan_queries,
 )
 
 
-@graph
-def execute_query(table_query):
+def count_and_extract(table_query):
     # get record count, end if 0
     count_outs = get_count(table_query=table_query)
 
     # get data and save file to data lake
-    get_data(
-        table=count_outs.table,
+    gcs_file_handles = get_data(
+        table_name=count_outs.table_name,
         projection=count_outs.projection,
         query=count_outs.query,
         n_pages=count_outs.n_pages,
+        is_resync=count_outs.is_resync,
+        mark_key=count_outs.mark_key,
     )
 
+    return count_outs, gcs_file_handles
+
 
 @graph
-def run_queries():
+def execute_query(table_query):
+    count_outs, _ = count_and_extract(table_query)
+
+    # small queries are deferred to a batched extract
+    return count_outs.batch_query
+
+
+@graph
+def execute_query_compacted(table_query):
+    count_outs, gcs_file_handles = count_and_extract(table_query)
+
+    # merge page files into sized objects
+    compact_files(gcs_file_handles)
+
+    return count_outs.batch_query
+
+
+def compose_and_extract(execute, compact):
     # parse queries from run config file (config/powerschool/query-*.yaml)
     ct_outs = compose_tables()
 
     # execute composed queries and filter parsed queries
-    ct_outs.dynamic_tables.map(execute_query)
+    ct_batch_queries = ct_outs.dynamic_tables.map(execute)
     fq_outs = filter_queries(ct_outs.table_queries)
 
     # execute composed queries, compose parsed queries & resyncs
-    fq_outs.dynamic_tables.map(execute_query)
+    fq_batch_queries = fq_outs.dynamic_tables.map(execute)
     cq_dynamic_tables = compose_queries(fq_outs.table_queries)
     cr_dynamic_tables = compose_resyncs(fq_outs.table_resyncs)
 
     # execute parsed queries and resyncs
-    cq_dynamic_tables.map(execute_query)
-    cr_dynamic_tables.map(execute_query)
+    cq_batch_queries = cq_dynamic_tables.map(execute)
+    cr_batch_queries = cr_dynamic_tables.map(execute)
+
+    # extract small queries together, one step per group
+    for suffix, batch_queries in [
+        ("t", ct_batch_queries),
+        ("fq", fq_batch_queries),
+        ("q", cq_batch_queries),
+        ("h", cr_batch_queries),
+    ]:
+        gcs_file_handles = get_data_batch.alias(f"get_data_batch_{suffix}")(
+            batch_queries.collect()
+        )
+        if compact:
+            compact_files.alias(f"compact_files_{suffix}")(gcs_file_handles)
+
+
+@graph
+def run_queries():
+    compose_and_extract(execute=execute_query, compact=False)
+
+
+@graph
+def run_queries_compacted():
+    """`run_queries`, merging each query's page files into sized objects.
+
+    Compaction deletes the page files, and with them the content hashes
+    `get_data`'s `skip_unchanged` compares against, so every page is uploaded
+    again on the next run. Set `skip_unchanged: false` for these jobs.
+    """
+    compose_and_extract(execute=execute_query_compacted, compact=True)
+
+
+@graph
+def run_planned_queries():
+    # compose and count every query from the run config in one step
+    plan_outs = plan_queries()
+
+    # only queries with records fan out, small ones are extracted together
+    plan_outs.planned_queries.map(get_data_planned)
+    get_data_batch(plan_outs.batch_queries)
+
+
+@graph
+def run_planned_queries_compacted():
+    """`run_planned_queries`, merging each query's page files into sized
+    objects. See `run_queries_compacted` for `skip_unchanged`."""
+    plan_outs = plan_queries()
+
+    plan_outs.planned_queries.map(get_data_planned).map(compact_files)
+    compact_files.alias("compact_files_batch")(get_data_batch(plan_outs.batch_queries))
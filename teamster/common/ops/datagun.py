@@ -1,14 +1,29 @@
 import gzip
+import itertools
 import json
 import pathlib
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 from dagster import (
+    Bool,
     Dict,
     DynamicOut,
     DynamicOutput,
+    Enum,
+    EnumValue,
+    ExpectationResult,
+    Failure,
+    Field,
     In,
+    Int,
     List,
     Out,
     Output,
@@ -16,9 +31,11 @@ from dagster import (
     Tuple,
     op,
 )
+from dagster.utils.merger import merge_dicts
 
 from teamster.common.config.datagun import COMPOSE_QUERIES_CONFIG
-from teamster.common.utils import CustomJSONEncoder, TODAY
+from teamster.common.resources.google import CONTENT_HASH_KEY
+from teamster.common.utils import TODAY, json_dumps
 
 
 @op(
@@ -98,16 +115,11 @@ def transform(context, data, file_config, dest_config):
 
     context.log.info(f"Transforming data to {file_suffix}")
     if file_suffix == "json.gz":
-        data_str = gzip.compress(
-            json.dumps(obj=data, cls=CustomJSONEncoder).encode("utf-8")
-        )
+        data_str = gzip.compress(json_dumps(data), mtime=0)
     elif file_suffix == "json":
-        data_str = json.dumps(obj=data, cls=CustomJSONEncoder).encode("utf-8")
+        data_str = json_dumps(data)
     elif file_suffix == "gsheet":
-        df = pd.DataFrame(data=data)
-        df_json = df.to_json(orient="split", date_format="iso", index=False)
-        df_dict = json.loads(df_json)
-        df_dict["shape"] = df.shape
+        df_dict = to_gsheet(data)
     elif file_suffix in ["csv", "txt", "tsv"]:
         df = pd.DataFrame(data=data)
         data_str = df.to_csv(index=False, **file_format).encode("utf-8")
@@ -115,22 +127,406 @@ def transform(context, data, file_config, dest_config):
     if dest_type == "gsheet":
         yield Output(value=(dest_type, (df_dict, file_stem)), output_name="transformed")
     elif dest_type == "sftp":
-        file_handle = context.resources.file_manager.upload_from_string(
+        file_handle, skipped = context.resources.file_manager.upload_if_changed(
             obj=data_str,
             file_key=f"{dest_name}/{file_stem}.{file_suffix}",
         )
-        context.log.info(f"Saved to {file_handle.path_desc}.")
+        if skipped:
+            context.log.info(f"Unchanged since last export: {file_handle.path_desc}.")
+        else:
+            context.log.info(f"Saved to {file_handle.path_desc}.")
 
         yield Output(
-            value=(dest_type, (file_handle, dest_path)), output_name="transformed"
+            value=(dest_type, (file_handle, dest_path)),
+            output_name="transformed",
+            metadata={"skipped_bytes": len(data_str) if skipped else 0},
         )
 
 
+def to_gsheet(data):
+    df = pd.DataFrame(data=data)
+    df_json = df.to_json(orient="split", date_format="iso", index=False)
+    df_dict = json.loads(df_json)
+    df_dict["shape"] = df.shape
+
+    return df_dict
+
+
+def get_column_dtype(values):
+    """Nullable pandas dtype for a column's non-null Python values, or None to
+    leave the column to pandas' inference."""
+    if all(isinstance(v, bool) for v in values):
+        return "boolean"
+    elif all(isinstance(v, int) and not isinstance(v, bool) for v in values):
+        return "Int64"
+    elif all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values):
+        return "float64"
+    else:
+        return None
+
+
+def encode_batches(batches, file_suffix, file_format):
+    """Yields the encoded file one chunk per batch of row dicts.
+
+    CSV column dtypes are pinned from the first batch with values in each
+    column, so a batch with nulls doesn't turn an integer column's 5 into 5.0.
+    """
+    if file_suffix in ["json", "json.gz"]:
+        yield b"["
+        for i, batch in enumerate(batches):
+            yield (b"," if i else b"") + json_dumps(batch)[1:-1]
+        yield b"]"
+    elif file_suffix in ["csv", "txt", "tsv"]:
+        header = file_format.get("header", True)
+        csv_format = {k: v for k, v in file_format.items() if k != "header"}
+
+        dtypes = {}
+        for i, batch in enumerate(batches):
+            df = pd.DataFrame(data=batch)
+
+            for c in df.columns:
+                if c in dtypes:
+                    continue
+
+                values = [row[c] for row in batch if row.get(c) is not None]
+                if values:
+                    dtypes[c] = get_column_dtype(values)
+            df = df.astype({c: t for c, t in dtypes.items() if t and c in df})
+
+            yield df.to_csv(
+                index=False, header=(header if i == 0 else False), **csv_format
+            ).encode("utf-8")
+    else:
+        raise ValueError(f"Cannot stream file suffix: {file_suffix}")
+
+
+def write_batches(fileobj, batches, file_suffix, file_format):
+    chunks = encode_batches(
+        batches=batches, file_suffix=file_suffix, file_format=file_format
+    )
+
+    if file_suffix == "json.gz":
+        with gzip.GzipFile(fileobj=fileobj, mode="wb", mtime=0) as f:
+            for chunk in chunks:
+                f.write(chunk)
+    else:
+        for chunk in chunks:
+            fileobj.write(chunk)
+
+
+# file.format options (pandas.DataFrame.to_csv kwargs) the Arrow CSV writer supports
+ARROW_CSV_OPTIONS = ["sep", "header"]
+
+
+def is_arrow_csv_type(arrow_type):
+    """Whether Arrow's CSV text for `arrow_type` can match pandas' to_csv.
+
+    Timestamps, times and durations are not: pandas picks their format per
+    batch from the values, e.g. dates only when every value is midnight, and
+    writes offsets as +00:00. Neither are decimals with a scale over 6, which
+    Python writes in scientific notation, e.g. 0E-7.
+    """
+    return (
+        pa.types.is_null(arrow_type)
+        or pa.types.is_integer(arrow_type)
+        or pa.types.is_floating(arrow_type)
+        or pa.types.is_boolean(arrow_type)
+        or pa.types.is_string(arrow_type)
+        or pa.types.is_date(arrow_type)
+        or (pa.types.is_decimal(arrow_type) and arrow_type.scale <= 6)
+    )
+
+
+def to_pandas_csv_values(table):
+    """Casts the columns whose Arrow CSV text differs from pandas' to_csv."""
+    for i, field in enumerate(table.schema):
+        column = table[i]
+
+        if pa.types.is_boolean(field.type):
+            column = pc.if_else(column, "True", "False")
+        elif pa.types.is_floating(field.type):
+            # pandas writes numpy's shortest repr, e.g. 1.0 rather than Arrow's 1
+            values = column.to_numpy()
+            column = pa.array(
+                values.astype(str), type=pa.string(), mask=np.isnan(values)
+            )
+        else:
+            continue
+
+        table = table.set_column(i, field.name, column)
+
+    return table
+
+
+def needs_csv_quotes(table, sep):
+    """Whether any column name or string value contains the delimiter, a quote or
+    a line break."""
+    special_chars = re.escape(sep + '"') + r"\r\n"
+
+    return any(re.search(f"[{special_chars}]", c) for c in table.column_names) or any(
+        pc.any(pc.match_substring_regex(column, f"[{special_chars}]")).as_py()
+        for column in table.columns
+        if pa.types.is_string(column.type)
+    )
+
+
+def write_arrow(fileobj, table, file_suffix, file_format, batch_size):
+    """Writes `table` as the python engine's `write_batches` would.
+
+    CSV is written natively by Arrow unless `file_format` has options Arrow has
+    no equivalent for, a column type's text would differ (`is_arrow_csv_type`)
+    or a value needs quoting: Arrow can quote every string or none, while
+    pandas only quotes the values that need it, and writes a lone empty field
+    as "". Those tables are written from their record batches by
+    `write_batches` instead.
+    """
+    sep = file_format.get("sep", ",")
+    header = file_format.get("header", True)
+
+    if file_suffix == "parquet":
+        pq.write_table(table, pa.PythonFile(fileobj, mode="w"), **file_format)
+    elif (
+        file_suffix in ["csv", "txt", "tsv"]
+        and not set(file_format) - set(ARROW_CSV_OPTIONS)
+        and isinstance(header, bool)
+        and all(is_arrow_csv_type(t) for t in table.schema.types)
+        and not (table.num_columns == 1 and table.column(0).null_count)
+        and not needs_csv_quotes(table=table, sep=sep)
+    ):
+        # Arrow always quotes the header
+        if header:
+            fileobj.write((sep.join(table.column_names) + "\n").encode("utf-8"))
+
+        pa_csv.write_csv(
+            to_pandas_csv_values(table),
+            pa.PythonFile(fileobj, mode="w"),
+            write_options=pa_csv.WriteOptions(
+                include_header=False, delimiter=sep, quoting_style="none"
+            ),
+        )
+    else:
+        write_batches(
+            fileobj=fileobj,
+            batches=(
+                batch.to_pylist()
+                for batch in table.to_batches(max_chunksize=batch_size)
+            ),
+            file_suffix=file_suffix,
+            file_format=file_format,
+        )
+
+
+def arrow_to_gsheet(table):
+    """Builds the same columns/data/shape payload as `to_gsheet`, column by
+    column, with dates and durations formatted as pandas' ISO JSON does."""
+    columns = []
+    for column in table.columns:
+        if pa.types.is_timestamp(column.type) or pa.types.is_date(column.type):
+            # pandas writes naive values as if they were UTC
+            if getattr(column.type, "tz", None):
+                column = column.cast(pa.timestamp("ms", tz="UTC"), safe=False)
+            else:
+                column = column.cast(pa.timestamp("ms"), safe=False)
+            column = pc.strftime(column, format="%Y-%m-%dT%H:%M:%SZ")
+        elif pa.types.is_decimal(column.type):
+            column = column.cast(pa.float64())
+        elif pa.types.is_duration(column.type):
+            column = pa.chunked_array(
+                [
+                    [
+                        None if v is None else pd.Timedelta(v).isoformat()
+                        for v in column.to_pylist()
+                    ]
+                ],
+                type=pa.string(),
+            )
+        elif pa.types.is_time(column.type):
+            column = pa.chunked_array(
+                [[None if v is None else str(v) for v in column.to_pylist()]],
+                type=pa.string(),
+            )
+
+        columns.append(column.to_pylist())
+
+    return {
+        "columns": table.column_names,
+        "data": [list(row) for row in zip(*columns)],
+        "shape": table.shape,
+    }
+
+
+EXTRACT_STREAM_CONFIG = {
+    "batch_size": Field(Int, is_required=False, default_value=10000),
+    "engine": Field(
+        Enum("DatagunEngine", [EnumValue("python"), EnumValue("arrow")]),
+        is_required=False,
+        default_value="python",
+    ),
+}
+
+
+def export_query(context, dynamic_query):
+    """Extracts, encodes and uploads one composed query.
+
+    engine:
+        python: streams cursor batches of row dicts straight into the file
+        arrow: collects cursor batches into a columnar Arrow table and writes it
+            natively, which also supports parquet
+
+    Returns (transformed, metadata), or None if the query returned no rows.
+    """
+    query, file_config, dest_config = dynamic_query
+
+    file_stem = file_config["stem"].format(TODAY.date().isoformat())
+    file_suffix = file_config["suffix"]
+    file_format = file_config.get("format", {})
+
+    dest_name = dest_config["name"]
+    dest_type = dest_config["type"]
+    dest_path = dest_config.get("path")
+
+    batch_size = context.op_config["batch_size"]
+    engine = context.op_config["engine"]
+
+    if engine == "arrow":
+        table = context.resources.db.execute_arrow_query(
+            query=query, batch_size=batch_size
+        )
+        if table.num_rows == 0:
+            return None
+    else:
+        batches = context.resources.db.stream_text_query(
+            query=query, batch_size=batch_size
+        )
+
+        first_batch = next(batches, None)
+        if first_batch is None:
+            return None
+        batches = itertools.chain([first_batch], batches)
+
+    if dest_type == "gsheet":
+        if engine == "arrow":
+            gsheet = arrow_to_gsheet(table)
+        else:
+            # sheet updates need the whole result at once
+            gsheet = to_gsheet([row for batch in batches for row in batch])
+
+        return (dest_type, (gsheet, file_stem)), {}
+    elif dest_type == "sftp":
+        context.log.info(f"Streaming data to {file_suffix}")
+        with context.resources.file_manager.open_writer(
+            file_key=f"{dest_name}/{file_stem}.{file_suffix}"
+        ) as writer:
+            if engine == "arrow":
+                write_arrow(
+                    fileobj=writer,
+                    table=table,
+                    file_suffix=file_suffix,
+                    file_format=file_format,
+                    batch_size=batch_size,
+                )
+            else:
+                write_batches(
+                    fileobj=writer,
+                    batches=batches,
+                    file_suffix=file_suffix,
+                    file_format=file_format,
+                )
+
+        context.log.info(f"Saved to {writer.file_handle.path_desc}.")
+
+        return (dest_type, (writer.file_handle, dest_path)), {"bytes": writer.n_bytes}
+
+
+@op(
+    ins={"dynamic_query": In(dagster_type=Tuple)},
+    out={"transformed": Out(dagster_type=Tuple, is_required=False)},
+    required_resource_keys={"db", "file_manager"},
+    config_schema=EXTRACT_STREAM_CONFIG,
+    tags={"dagster/priority": 2},
+)
+def extract_stream(context, dynamic_query):
+    """Extracts, encodes and uploads in one step, so only the file handle is
+    passed downstream."""
+    export = export_query(context=context, dynamic_query=dynamic_query)
+
+    if export is not None:
+        transformed, metadata = export
+        yield Output(value=transformed, output_name="transformed", metadata=metadata)
+
+
+@op(
+    ins={"dynamic_queries": In(dagster_type=List[Tuple])},
+    out={"transformed": DynamicOut(dagster_type=Tuple, is_required=False)},
+    required_resource_keys={"db", "file_manager"},
+    config_schema=merge_dicts(
+        EXTRACT_STREAM_CONFIG,
+        {"max_concurrent": Field(Int, is_required=False, default_value=4)},
+    ),
+    tags={"dagster/priority": 2},
+)
+def extract_batch(context, dynamic_queries):
+    """Exports every composed query in one step, with at most `max_concurrent`
+    queries, and so DB sessions, running at once.
+
+    A failed query doesn't stop the others: every successful export is yielded
+    before the step fails, naming the queries that didn't export.
+    """
+    context.log.info(f"Extracting {len(dynamic_queries)} queries in one step.")
+
+    mapping_keys = [
+        re.sub(r"[^A-Za-z0-9_]+", "", dynamic_query[1]["stem"]) + f"_{i}"
+        for i, dynamic_query in enumerate(dynamic_queries)
+    ]
+
+    def _export(dynamic_query):
+        start = time.monotonic()
+        export = export_query(context=context, dynamic_query=dynamic_query)
+        return time.monotonic() - start, export
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=context.op_config["max_concurrent"]) as ex:
+        futures = [ex.submit(_export, dq) for dq in dynamic_queries]
+
+        for mapping_key, future in zip(mapping_keys, futures):
+            try:
+                seconds, export = future.result()
+            except Exception as e:
+                context.log.error(f"Failed to export {mapping_key}: {e}")
+                failed.append(mapping_key)
+                continue
+
+            context.log.info(f"Exported {mapping_key} in {seconds:.3f}s.")
+            if export is not None:
+                transformed, metadata = export
+                yield DynamicOutput(
+                    value=transformed,
+                    output_name="transformed",
+                    mapping_key=mapping_key,
+                    metadata=merge_dicts(metadata, {"seconds": seconds}),
+                )
+
+    if failed:
+        raise Failure(
+            description=(
+                f"{len(failed)} of {len(dynamic_queries)} queries failed to export: "
+                f"{', '.join(failed)}"
+            )
+        )
+
+
+TRANSFERRED_HASH_KEY = "transferred_sha256"
+
+
 @op(
     ins={"transformed": In(dagster_type=Tuple)},
     tags={"dagster/priority": 4},
     required_resource_keys={"destination", "file_manager"},
     retry_policy=RetryPolicy(max_retries=2),
+    config_schema={
+        # only for destinations that keep what they were last sent
+        "skip_unchanged": Field(Bool, is_required=False, default_value=False)
+    },
 )
 def load_destination(context, transformed):
     dest_type, transformed_ins = transformed
@@ -142,6 +538,27 @@ def load_destination(context, transformed):
         )
     elif dest_type == "sftp":
         file_handle, dest_path = transformed_ins
+        file_manager = context.resources.file_manager
+
+        # the staged object records the content hash it last sent
+        content_hash = None
+        if context.op_config["skip_unchanged"]:
+            blob = file_manager.get_blob(file_handle=file_handle)
+            metadata = (blob.metadata or {}) if blob is not None else {}
+            content_hash = metadata.get(CONTENT_HASH_KEY)
+
+        if content_hash and metadata.get(TRANSFERRED_HASH_KEY) == content_hash:
+            context.log.info(
+                f"{file_handle.path_desc} unchanged since last transfer. Skipping."
+            )
+            context.log_event(
+                ExpectationResult(
+                    success=True,
+                    label="sftp_transfer",
+                    metadata={"skipped_bytes": blob.size},
+                )
+            )
+            return
 
         sftp_conn = context.resources.destination.get_connection()
         file_name = pathlib.Path(file_handle.gcs_key).name
@@ -175,8 +592,9 @@ def load_destination(context, transformed):
             )
 
             with sftp.file(file_name, "w") as f:
-                f.write(
-                    context.resources.file_manager.download_as_bytes(
-                        file_handle=file_handle
-                    )
-                )
+                f.write(file_manager.download_as_bytes(file_handle=file_handle))
+
+        if content_hash:
+            file_manager.update_metadata(
+                file_handle=file_handle, metadata={TRANSFERRED_HASH_KEY: content_hash}
+            )
@@ -1,15 +1,25 @@
+import asyncio
+import datetime
 import gzip
-import json
 import math
+import random
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import aiohttp
+import pyarrow as pa
+import pyarrow.parquet as pq
 from dagster import (
-    Any,
     Backoff,
     Bool,
     DynamicOut,
     DynamicOutput,
+    Enum,
+    EnumValue,
+    Failure,
     Field,
+    Float,
     In,
     Int,
     Jitter,
@@ -24,6 +34,9 @@ from dagster import (
     Tuple,
     op,
 )
+from dagster.utils.merger import merge_dicts
+from dagster_gcp import GCSFileHandle
+from gcloud.aio.storage import Storage
 from powerschool.utils import (
     generate_historical_queries,
     get_constraint_rules,
@@ -33,59 +46,221 @@ from powerschool.utils import (
 )
 from requests.exceptions import HTTPError
 
-from teamster.common.config.powerschool import COMPOSE_QUERIES_CONFIG
-from teamster.common.utils import TODAY, get_last_schedule_run, time_limit
+from teamster.common.config.powerschool import (
+    COMPOSE_QUERIES_CONFIG,
+    COMPOSE_QUERIES_FIELDS,
+)
+from teamster.common.resources.powerschool import AsyncPowerSchool
+from teamster.common.utils import (
+    LOCAL_TIME_ZONE,
+    TODAY,
+    json_dumps,
+    run_pipeline,
+    time_limit,
+)
+
+
+COMPOSE_RESYNCS_CONFIG = {
+    "step_size": Field(Int, is_required=False, default_value=30000),
+    "force": Field(Bool, is_required=False, default_value=False),
+    "partition_mode": Field(
+        Enum("PartitionMode", [EnumValue("fixed"), EnumValue("adaptive")]),
+        is_required=False,
+        default_value="fixed",
+    ),
+    "target_pages": Field(Int, is_required=False, default_value=10),
+    "query_timeout": Field(Float, is_required=False, default_value=30),
+    "max_workers": Field(Int, is_required=False, default_value=10),
+}
 
 
 @op(
     ins={"table_resyncs": In(dagster_type=List[Tuple])},
     out={"dynamic_tables": DynamicOut(dagster_type=Tuple, is_required=False)},
-    config_schema={
-        "step_size": Field(Int, is_required=False, default_value=30000),
-        "force": Field(Bool, is_required=False, default_value=False),
-    },
+    config_schema=COMPOSE_RESYNCS_CONFIG,
+    required_resource_keys={"powerschool", "file_manager"},
     tags={"dagster/priority": 1},
 )
 def compose_resyncs(context, table_resyncs):
+    yield from compose_resyncs_outputs(context=context, table_resyncs=table_resyncs)
+
+
+def compose_resyncs_outputs(context, table_resyncs):
     for tr in table_resyncs:
-        year_id, table, projection, selector, max_value = tr
-
-        context.log.info(f"Generating historical queries for {table.name}.")
-
-        if not max_value and selector[-2:] == "id":
-            max_value = int(
-                table.query(
-                    projection=selector,
-                    sort=selector,
-                    sortdescending="true",
-                    pagesize=1,
-                    page=1,
-                )[0][selector]
-            )
-            place_value = 10 ** (len(str(max_value)) - 1)
-            max_val_ceil = math.ceil(max_value / place_value) * place_value
-            max_value = max_val_ceil
-        elif not max_value:
-            max_value = transform_year_id(year_id, selector)
-        context.log.debug(f"max_value:\t{max_value}")
+        year_id, table_name, projection, selector, max_value = tr
+
+        context.log.info(f"Generating historical queries for {table_name}.")
+
+        table = context.resources.powerschool.get_schema_table(table_name)
         constraint_rules = get_constraint_rules(
             selector, year_id=year_id, is_historical=True
         )
 
-        historical_queries = generate_historical_queries(
-            selector=selector,
-            start_value=max_value,
-            stop_value=constraint_rules["stop_value"],
-            step_size=context.op_config["step_size"],
+        if context.op_config["partition_mode"] == "adaptive" and selector[-2:] == "id":
+            historical_queries = generate_adaptive_queries(
+                context=context,
+                table=table,
+                selector=selector,
+                min_value=int(constraint_rules["stop_value"] or 0),
+                max_value=(
+                    int(max_value)
+                    if max_value
+                    else get_max_value(table=table, selector=selector)
+                ),
+            )
+        else:
+            if not max_value and selector[-2:] == "id":
+                max_value = get_max_value(table=table, selector=selector)
+                place_value = 10 ** (len(str(max_value)) - 1)
+                max_val_ceil = math.ceil(max_value / place_value) * place_value
+                max_value = max_val_ceil
+            elif not max_value:
+                max_value = transform_year_id(year_id, selector)
+            context.log.debug(f"max_value:\t{max_value}")
+
+            historical_queries = generate_historical_queries(
+                selector=selector,
+                start_value=max_value,
+                stop_value=constraint_rules["stop_value"],
+                step_size=context.op_config["step_size"],
+            )
+            historical_queries.reverse()
+
+        completed_resyncs = get_completed_resyncs(
+            context=context, table_name=table_name
         )
-        historical_queries.reverse()
+        if context.op_config["force"]:
+            completed_resyncs = set()
+        elif completed_resyncs:
+            context.log.info(
+                f"Skipping {len(completed_resyncs)} partitions completed by a "
+                "previous try of this run."
+            )
 
         for i, hq in enumerate(historical_queries):
+            if hq in completed_resyncs:
+                continue
+
             yield DynamicOutput(
-                value=(table, projection, hq, True),
+                value=(table_name, projection, hq, True, None),
                 output_name="dynamic_tables",
-                mapping_key=f"{re.sub(r'[^A-Za-z0-9]', '_', table.name)}_h_{i}",
+                mapping_key=f"{re.sub(r'[^A-Za-z0-9]', '_', table_name)}_h_{i}",
+            )
+
+
+RESYNC_MANIFEST_PREFIX = "_resync_manifest/{table_name}/"
+
+
+def get_resync_attempt_id(context):
+    """Re-executions of a run share its root run ID, so they resume its
+    resync; any other run starts a new one."""
+    return context.pipeline_run.root_run_id or context.run_id
+
+
+def get_completed_resyncs(context, table_name):
+    """Returns the partitions completed by this resync attempt, and removes
+    markers left by any other attempt, finished or not."""
+    prefix = RESYNC_MANIFEST_PREFIX.format(table_name=table_name)
+    attempt_prefix = f"{prefix}{get_resync_attempt_id(context)}/"
+
+    completed_resyncs = set()
+    stale_keys = []
+    for key in context.resources.file_manager._list_keys(prefix=prefix):
+        if key.startswith(attempt_prefix):
+            completed_resyncs.add(key[len(attempt_prefix) :])
+        else:
+            stale_keys.append(key)
+
+    if stale_keys:
+        context.resources.file_manager._rm_keys(keys=stale_keys)
+
+    return completed_resyncs
+
+
+def set_completed_resync(context, table_name, query):
+    context.resources.file_manager.upload_from_string(
+        obj=b"",
+        file_key=(
+            RESYNC_MANIFEST_PREFIX.format(table_name=table_name)
+            + f"{get_resync_attempt_id(context)}/{query}"
+        ),
+        mode="overwrite",
+    )
+
+
+def get_max_value(table, selector):
+    return int(
+        table.query(
+            projection=selector,
+            sort=selector,
+            sortdescending="true",
+            pagesize=1,
+            page=1,
+        )[0][selector]
+    )
+
+
+def generate_adaptive_queries(context, table, selector, min_value, max_value):
+    """Splits [min_value, max_value] into ranges of about `target_pages` pages.
+
+    Ranges are bisected until their count fits the target, then adjacent ranges
+    are merged while they still fit, so empty ranges never become their own
+    partition. The last range is open-ended to pick up records created since.
+    """
+    target_count = (
+        context.op_config["target_pages"]
+        * table.client.metadata.schema_table_query_max_page_size
+    )
+
+    def _range_query(lo, hi):
+        return ";".join(
+            filter(
+                None,
+                [
+                    f"{selector}=ge={lo}",
+                    f"{selector}=lt={hi}" if hi is not None else None,
+                ],
             )
+        )
+
+    def _count(lo_hi):
+        lo, hi = lo_hi
+        count = time_limit_count(
+            context=context, table=table, query=_range_query(lo, hi), count_type="query"
+        )
+        return lo, hi, count
+
+    ranges = []
+    frontier = [(min_value, max_value + 1)]
+    with ThreadPoolExecutor(max_workers=context.op_config["max_workers"]) as ex:
+        while frontier:
+            next_frontier = []
+            for lo, hi, count in ex.map(_count, frontier):
+                if count > target_count and hi - lo > 1:
+                    mid = (lo + hi) // 2
+                    next_frontier.extend([(lo, mid), (mid, hi)])
+                else:
+                    ranges.append((lo, hi, count))
+            frontier = next_frontier
+    ranges.sort()
+
+    partitions = []
+    for lo, hi, count in ranges:
+        if partitions and partitions[-1][2] + count <= target_count:
+            p_lo, _, p_count = partitions[-1]
+            partitions[-1] = (p_lo, hi, p_count + count)
+        else:
+            partitions.append((lo, hi, count))
+
+    context.log.info(
+        f"Partitioned {selector} {min_value}-{max_value} into {len(partitions)} "
+        f"ranges using {len(ranges)} range counts."
+    )
+
+    return [
+        _range_query(lo, hi if i < len(partitions) - 1 else None)
+        for i, (lo, hi, _) in enumerate(partitions)
+    ]
 
 
 @op(
@@ -94,8 +269,12 @@ def compose_resyncs(context, table_resyncs):
     tags={"dagster/priority": 2},
 )
 def compose_queries(context, table_queries):
+    yield from compose_queries_outputs(table_queries=table_queries)
+
+
+def compose_queries_outputs(table_queries):
     for ftq in table_queries:
-        year_id, table, mapping_key, projection, selector, value = ftq
+        year_id, table_name, mapping_key, projection, selector, value, watermark = ftq
 
         constraint_rules = get_constraint_rules(selector=selector, year_id=year_id)
 
@@ -108,7 +287,7 @@ def compose_queries(context, table_queries):
         composed_query = get_query_expression(selector=selector, **constraint_values)
 
         yield DynamicOutput(
-            value=(table, projection, composed_query, False),
+            value=(table_name, projection, composed_query, False, watermark),
             output_name="dynamic_tables",
             mapping_key=mapping_key,
         )
@@ -124,21 +303,28 @@ def compose_queries(context, table_queries):
     tags={"dagster/priority": 3},
 )
 def filter_queries(context, table_queries):
+    yield from filter_queries_outputs(table_queries=table_queries)
+
+
+def filter_queries_outputs(table_queries):
     table_queries_filtered = []
     table_resyncs = []
 
     for tbl in table_queries:
-        year_id, table, projection, queries = tbl
+        year_id, table_name, projection, queries, high_water_marks = tbl
 
         for i, query in enumerate(queries):
-            mapping_key = f"{re.sub(r'[^A-Za-z0-9]', '_', table.name)}_q_{i}"
+            mapping_key = f"{re.sub(r'[^A-Za-z0-9]', '_', table_name)}_q_{i}"
 
             projection = query.get("projection", projection)
             q = query.get("q")
 
             if isinstance(q, str):
+                watermark = get_watermark(
+                    high_water_marks=high_water_marks, projection=projection, query_id=q
+                )
                 yield DynamicOutput(
-                    value=(table, projection, q, False),
+                    value=(table_name, projection, q, False, watermark),
                     output_name="dynamic_tables",
                     mapping_key=mapping_key,
                 )
@@ -146,17 +332,31 @@ def filter_queries(context, table_queries):
                 selector = q["selector"]
                 max_value = q.get("max_value")
                 value = q.get("value", transform_year_id(year_id, selector))
+                query_id = f"{selector}={value}"
 
                 if value == "today":
                     value = TODAY.date().isoformat()
 
                 if value == "resync":
                     table_resyncs.append(
-                        (year_id, table, projection, selector, max_value)
+                        (year_id, table_name, projection, selector, max_value)
                     )
                 else:
+                    watermark = get_watermark(
+                        high_water_marks=high_water_marks,
+                        projection=projection,
+                        query_id=query_id,
+                    )
                     table_queries_filtered.append(
-                        (year_id, table, mapping_key, projection, selector, value)
+                        (
+                            year_id,
+                            table_name,
+                            mapping_key,
+                            projection,
+                            selector,
+                            value,
+                            watermark,
+                        )
                     )
 
     if table_queries_filtered:
@@ -172,26 +372,39 @@ def filter_queries(context, table_queries):
         "dynamic_tables": DynamicOut(dagster_type=Tuple, is_required=False),
         "table_queries": Out(dagster_type=List[Tuple], is_required=False),
     },
-    required_resource_keys={"powerschool"},
+    required_resource_keys={"file_manager"},
     tags={"dagster/priority": 4},
 )
 def compose_tables(context):
-    tables = context.op_config["tables"]
-    year_id = context.op_config["year_id"]
+    yield from compose_tables_outputs(
+        context=context,
+        tables=context.op_config["tables"],
+        year_id=context.op_config["year_id"],
+    )
 
+
+def compose_tables_outputs(context, tables, year_id):
     table_queries = []
     for i, tbl in enumerate(tables):
-        table = context.resources.powerschool.get_schema_table(tbl["name"])
+        table_name = tbl["name"]
         projection = tbl.get("projection")
         queries = [fq for fq in tbl.get("queries", {}) if fq.get("q")]
 
+        # read once per table per run, passed on with each query
+        high_water_marks = get_high_water_marks(context=context, table_name=table_name)
+
         if queries:
-            table_queries.append((year_id, table, projection, queries))
+            table_queries.append(
+                (year_id, table_name, projection, queries, high_water_marks)
+            )
         else:
+            watermark = get_watermark(
+                high_water_marks=high_water_marks, projection=projection, query_id=""
+            )
             yield DynamicOutput(
-                value=(table, projection, None, False),
+                value=(table_name, projection, None, False, watermark),
                 output_name="dynamic_tables",
-                mapping_key=f"{re.sub(r'[^A-Za-z0-9]', '_', table.name)}_t_{i}",
+                mapping_key=f"{re.sub(r'[^A-Za-z0-9]', '_', table_name)}_t_{i}",
             )
 
     if table_queries:
@@ -206,23 +419,22 @@ def table_count(context, table, query):
         raise e
 
 
-def time_limit_count(context, table, query, count_type):
+def time_limit_count(context, table, query, count_type, high_water_mark=None):
     if count_type == "incremental":
-        last_run_datetime = get_last_schedule_run(context)
-        if last_run_datetime:
-            last_run_date = last_run_datetime.date().isoformat()
+        if high_water_mark:
+            since = high_water_mark.astimezone(tz=LOCAL_TIME_ZONE).strftime(
+                "%Y-%m-%dT%H:%M:%S"
+            )
         else:
             # proceed to original query count
-            context.log.info("No Schedule - Skipping `transaction_date` count.")
+            context.log.info("No high-water mark - Skipping `transaction_date` count.")
             return 1
 
-        context.log.info(
-            f"Searching for matching records updated since {last_run_date}."
-        )
+        context.log.info(f"Searching for matching records updated since {since}.")
 
         query = ";".join(
             [
-                f"transaction_date=ge={last_run_date}",
+                f"transaction_date=ge={since}",
                 str(query or ""),
             ]
         )
@@ -242,23 +454,63 @@ def time_limit_count(context, table, query, count_type):
 @op(
     ins={"table_query": In(dagster_type=Tuple)},
     out={
-        "table": Out(dagster_type=Any, is_required=False),
+        "table_name": Out(dagster_type=String, is_required=False),
         "projection": Out(dagster_type=Optional[String], is_required=False),
         "query": Out(dagster_type=Optional[String], is_required=False),
         "n_pages": Out(dagster_type=Int, is_required=False),
         "no_count": Out(dagster_type=Nothing, is_required=False),
+        "is_resync": Out(dagster_type=Bool, is_required=False),
+        "mark_key": Out(dagster_type=Optional[String], is_required=False),
+        "batch_query": Out(dagster_type=Tuple, is_required=False),
     },
+    required_resource_keys={"powerschool", "file_manager"},
     retry_policy=RetryPolicy(
         max_retries=5, delay=30, backoff=Backoff.EXPONENTIAL, jitter=Jitter.PLUS_MINUS
     ),
     config_schema={
-        "query_timeout": Field(Int, is_required=False, default_value=30),
+        "query_timeout": Field(Float, is_required=False, default_value=30),
         "skip_incremental": Field(Bool, is_required=False),
+        "batch_max_pages": Field(Int, is_required=False, default_value=0),
     },
     tags={"dagster/priority": 5},
 )
 def get_count(context, table_query):
-    table, projection, query, is_resync = table_query
+    table_name, projection, query, is_resync, watermark = table_query
+    mark_key, high_water_mark = watermark or (None, None)
+
+    try:
+        n_pages = count_query(
+            context=context,
+            table=context.resources.powerschool.get_schema_table(table_name),
+            projection=projection,
+            query=query,
+            is_resync=is_resync,
+            high_water_mark=parse_high_water_mark(high_water_mark),
+        )
+    except Exception as e:
+        raise RetryRequested(
+            max_retries=context.op_def.retry_policy.max_retries,
+            seconds_to_wait=context.op_def.retry_policy.delay,
+        ) from e
+
+    if n_pages == 0:
+        return Output(value=None, output_name="no_count")
+    elif n_pages <= context.op_config["batch_max_pages"]:
+        context.log.info("Deferring to batched extract.")
+        yield Output(
+            value=(table_name, projection, query, n_pages, is_resync, mark_key),
+            output_name="batch_query",
+        )
+    else:
+        yield Output(value=table_name, output_name="table_name")
+        yield Output(value=query, output_name="query")
+        yield Output(value=projection, output_name="projection")
+        yield Output(value=n_pages, output_name="n_pages")
+        yield Output(value=is_resync, output_name="is_resync")
+        yield Output(value=mark_key, output_name="mark_key")
+
+
+def count_query(context, table, projection, query, is_resync, high_water_mark):
     context.log.info(
         f"table:\t\t{table.name}\nprojection:\t{projection}\nq:\t\t{query}"
     )
@@ -267,45 +519,172 @@ def get_count(context, table_query):
         context.log.info("Skipping `transaction_date` count.")
         updated_count = 1
     else:
-        try:
-            # count query records updated since last run
-            updated_count = time_limit_count(
-                context=context, table=table, query=query, count_type="incremental"
-            )
-        except Exception as e:
-            raise RetryRequested(
-                max_retries=context.op_def.retry_policy.max_retries,
-                seconds_to_wait=context.op_def.retry_policy.delay,
-            ) from e
+        # count query records updated since last run
+        updated_count = time_limit_count(
+            context=context,
+            table=table,
+            query=query,
+            count_type="incremental",
+            high_water_mark=high_water_mark,
+        )
 
     if updated_count > 0:
-        try:
-            # count all records in query
-            query_count = time_limit_count(
-                context=context, table=table, query=query, count_type="query"
-            )
-        except Exception as e:
-            raise RetryRequested(
-                max_retries=context.op_def.retry_policy.max_retries,
-                seconds_to_wait=context.op_def.retry_policy.delay,
-            ) from e
+        # count all records in query
+        query_count = time_limit_count(
+            context=context, table=table, query=query, count_type="query"
+        )
     else:
         context.log.info("No record updates since last run. Skipping.")
-        return Output(value=None, output_name="no_count")
+        return 0
 
     context.log.info(f"count:\t{query_count}")
-    if query_count > 0:
-        n_pages = math.ceil(
-            query_count / table.client.metadata.schema_table_query_max_page_size
+    n_pages = math.ceil(
+        query_count / table.client.metadata.schema_table_query_max_page_size
+    )
+    context.log.info(f"total pages:\t{n_pages}")
+
+    if is_resync and n_pages == 0:
+        # empty partitions are complete as well
+        set_completed_resync(context=context, table_name=table.name, query=query)
+
+    return n_pages
+
+
+@op(
+    config_schema=merge_dicts(
+        COMPOSE_QUERIES_FIELDS,
+        COMPOSE_RESYNCS_CONFIG,
+        {
+            "skip_incremental": Field(Bool, is_required=False),
+            "batch_max_pages": Field(Int, is_required=False, default_value=0),
+        },
+    ),
+    out={
+        "planned_queries": DynamicOut(dagster_type=Tuple, is_required=False),
+        "batch_queries": Out(dagster_type=List[Tuple], is_required=False),
+    },
+    required_resource_keys={"powerschool", "file_manager"},
+    retry_policy=RetryPolicy(
+        max_retries=5, delay=30, backoff=Backoff.EXPONENTIAL, jitter=Jitter.PLUS_MINUS
+    ),
+    tags={"dagster/priority": 5},
+)
+def plan_queries(context):
+    # compose every query up front instead of fanning out per compose op
+    composed, outs = split_outputs(
+        compose_tables_outputs(
+            context=context,
+            tables=context.op_config["tables"],
+            year_id=context.op_config["year_id"],
         )
-        context.log.info(f"total pages:\t{n_pages}")
+    )
 
-        yield Output(value=table, output_name="table")
-        yield Output(value=query, output_name="query")
-        yield Output(value=projection, output_name="projection")
-        yield Output(value=n_pages, output_name="n_pages")
-    else:
-        return Output(value=None, output_name="no_count")
+    if "table_queries" in outs:
+        filtered, outs = split_outputs(
+            filter_queries_outputs(table_queries=outs["table_queries"])
+        )
+        composed.extend(filtered)
+
+        if "table_queries" in outs:
+            composed.extend(
+                split_outputs(
+                    compose_queries_outputs(table_queries=outs["table_queries"])
+                )[0]
+            )
+
+        if "table_resyncs" in outs:
+            composed.extend(
+                split_outputs(
+                    compose_resyncs_outputs(
+                        context=context, table_resyncs=outs["table_resyncs"]
+                    )
+                )[0]
+            )
+
+    context.log.info(f"Counting {len(composed)} queries.")
+
+    tables = {}
+
+    def _count(mapping_key_table_query):
+        mapping_key, (
+            table_name,
+            projection,
+            query,
+            is_resync,
+            watermark,
+        ) = mapping_key_table_query
+        mark_key, high_water_mark = watermark or (None, None)
+
+        table = tables.get(table_name)
+        if table is None:
+            table = tables.setdefault(
+                table_name, context.resources.powerschool.get_schema_table(table_name)
+            )
+
+        n_pages = count_query(
+            context=context,
+            table=table,
+            projection=projection,
+            query=query,
+            is_resync=is_resync,
+            high_water_mark=parse_high_water_mark(high_water_mark),
+        )
+
+        return mapping_key, (
+            table_name,
+            projection,
+            query,
+            n_pages,
+            is_resync,
+            mark_key,
+        )
+
+    try:
+        with ThreadPoolExecutor(max_workers=context.op_config["max_workers"]) as ex:
+            counted = list(ex.map(_count, composed))
+    except Exception as e:
+        raise RetryRequested(
+            max_retries=context.op_def.retry_policy.max_retries,
+            seconds_to_wait=context.op_def.retry_policy.delay,
+        ) from e
+
+    batch_queries = []
+    n_planned = 0
+    for mapping_key, planned_query in counted:
+        n_pages = planned_query[3]
+
+        if n_pages == 0:
+            continue
+        elif n_pages <= context.op_config["batch_max_pages"]:
+            batch_queries.append(planned_query)
+        else:
+            n_planned += 1
+            yield DynamicOutput(
+                value=planned_query,
+                output_name="planned_queries",
+                mapping_key=mapping_key,
+            )
+
+    context.log.info(
+        f"Planned {n_planned} queries and {len(batch_queries)} batched queries, "
+        f"skipped {len(counted) - n_planned - len(batch_queries)} with no records."
+    )
+
+    if batch_queries:
+        yield Output(value=batch_queries, output_name="batch_queries")
+
+
+def split_outputs(outputs):
+    dynamic_outputs = []
+    outputs_by_name = {}
+
+    for output in outputs:
+        if isinstance(output, DynamicOutput):
+            dynamic_outputs.append((output.mapping_key, output.value))
+        else:
+            outputs_by_name[output.output_name] = output.value
+
+    return dynamic_outputs, outputs_by_name
 
 
 def table_query(context, table, query, projection, page):
@@ -316,83 +695,861 @@ def table_query(context, table, query, projection, page):
         raise e
 
 
-def time_limit_query(context, table, query, projection, page, retry=False):
-    with time_limit(context.op_config["query_timeout"]):
+def get_status_code(e):
+    """HTTP status code behind an exception, or None.
+
+    The PowerSchool client re-raises every HTTPError as `HTTPError(body)`
+    without its response, from inside the handler for the original error, so
+    the response is found on the exception chain. `AsyncPowerSchool` does the
+    same with aiohttp's error, which holds only the status.
+    """
+    while e is not None:
+        response = getattr(e, "response", None)
+        if response is not None:
+            return response.status_code
+        elif isinstance(e, aiohttp.ClientResponseError):
+            return e.status
+        e = e.__cause__ or e.__context__
+    return None
+
+
+def is_retryable(e):
+    """Only client errors (HTTP 4xx other than 408/429), e.g. an invalid query,
+    are fatal. Timeouts, dropped connections, throttling, server errors and
+    anything unclassified are treated as transient."""
+    if isinstance(e, HTTPError):
+        status_code = get_status_code(e)
+        return (
+            status_code is None
+            or status_code in [408, 429]
+            or not 400 <= status_code < 500
+        )
+    else:
+        return True
+
+
+def time_limit_query(context, table, query, projection, page):
+    max_retries = context.op_config["page_retries"]
+
+    for attempt in range(max_retries + 1):
         try:
-            return table_query(
-                context=context,
-                table=table,
-                query=query,
-                projection=projection,
-                page=page,
-            )
-        except Exception as e:
-            if retry:
-                raise e
-            else:
-                # retry page before retrying entire Op
-                return time_limit_query(
+            with time_limit(context.op_config["query_timeout"]):
+                return table_query(
                     context=context,
                     table=table,
                     query=query,
                     projection=projection,
                     page=page,
-                    retry=True,
                 )
+        except Exception as e:
+            if attempt == max_retries or not is_retryable(e):
+                raise e
+
+            # retry page before retrying entire Op
+            delay = get_page_retry_delay(context=context, attempt=attempt)
+
+            context.log.warning(
+                f"Retrying page {page} in {delay:.1f}s "
+                f"({attempt + 1}/{max_retries})."
+            )
+            time.sleep(delay)
+
+
+def get_page_retry_delay(context, attempt):
+    return min(
+        context.op_config["page_retry_max_delay"],
+        context.op_config["page_retry_delay"] * 2**attempt,
+    ) * random.uniform(0.5, 1.5)
+
+
+def get_page_error(context, page, e):
+    """Fails the step on a page's fatal error, or asks for it to be retried."""
+    if not is_retryable(e):
+        return Failure(description=f"Page {page + 1} failed: {e}")
+
+    return RetryRequested(
+        max_retries=context.op_def.retry_policy.max_retries,
+        seconds_to_wait=context.op_def.retry_policy.delay,
+    )
+
+
+def fetch_page(context, table, projection, query, page, n_pages):
+    context.log.debug(f"page:\t{(page + 1)}/{n_pages}")
+
+    try:
+        return time_limit_query(
+            context=context,
+            table=table,
+            query=query,
+            projection=projection,
+            page=(page + 1),
+        )
+    except Exception as e:
+        raise get_page_error(context=context, page=page, e=e) from e
+
+
+async def fetch_page_async(
+    context, client, table_name, projection, query, page, n_pages
+):
+    """`fetch_page` through an `AsyncPowerSchool` client. Each attempt is
+    cancelled once it runs past `query_timeout`."""
+    context.log.debug(f"page:\t{(page + 1)}/{n_pages}")
+
+    max_retries = context.op_config["page_retries"]
+    for attempt in range(max_retries + 1):
+        try:
+            return await asyncio.wait_for(
+                client.query(
+                    table_name=table_name,
+                    q=query,
+                    projection=projection,
+                    page=(page + 1),
+                ),
+                timeout=context.op_config["query_timeout"],
+            )
+        except Exception as e:
+            if attempt == max_retries or not is_retryable(e):
+                context.log.error(e)
+                raise get_page_error(context=context, page=page, e=e) from e
+
+            # retry page before retrying entire Op
+            delay = get_page_retry_delay(context=context, attempt=attempt)
+
+            context.log.warning(
+                f"Retrying page {page + 1} in {delay:.1f}s "
+                f"({attempt + 1}/{max_retries})."
+            )
+            await asyncio.sleep(delay)
+
+
+def get_table_projection(context, table):
+    """The projection the client queries when given none: every column the
+    plugin can access."""
+    with time_limit(context.op_config["query_timeout"]):
+        metadata = table.metadata(expansions="access")
+
+    return ",".join(
+        c["name"].lower()
+        for c in metadata.get("columns", [])
+        if c.get("access") not in ["NoAccess", "BlackListNoAccess"]
+    )
+
+
+async def extract_pages_async(
+    context, table, projection, query, pages, n_pages, serialize
+):
+    """Fetches, serializes and uploads `pages` from one event loop, with at most
+    `max_workers` pages in flight.
+
+    Pages are fetched with aiohttp and uploaded with gcloud-aio-storage, so
+    waiting on the network holds no threads, and a request that runs past its
+    timeout is cancelled. Serialization runs on one worker thread, as in the
+    pipeline, so it doesn't stall the loop.
+
+    Returns [(file_handle, skipped bytes)] in page order.
+    """
+    file_manager = context.resources.file_manager
+    skip_unchanged = context.op_config["skip_unchanged"]
+
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(context.op_config["max_workers"])
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        async with aiohttp.ClientSession() as session:
+            client = AsyncPowerSchool(client=table.client, session=session)
+            storage = Storage(session=session)
+
+            async def _extract_page(page, file_key):
+                async with semaphore:
+                    data = await fetch_page_async(
+                        context=context,
+                        client=client,
+                        table_name=table.name,
+                        projection=projection,
+                        query=query,
+                        page=page,
+                        n_pages=n_pages,
+                    )
+
+                    _, obj = await loop.run_in_executor(
+                        executor, serialize, (file_key, data)
+                    )
+
+                    file_handle, skipped = await file_manager.upload_async(
+                        storage=storage,
+                        obj=obj,
+                        file_key=file_key,
+                        skip_unchanged=skip_unchanged,
+                    )
+
+                    return file_handle, (len(obj) if skipped else 0)
+
+            tasks = [
+                asyncio.ensure_future(_extract_page(page, file_key))
+                for page, file_key in pages
+            ]
+            try:
+                return await asyncio.gather(*tasks)
+            except BaseException as e:
+                # stop the other pages before the session closes under them
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise e
+
+
+def extract_query(
+    context, table, projection, query, n_pages, is_resync=False, mark_key=None
+):
+    file_stem = "_".join(filter(None, [table.name, str(query or "")]))
+
+    if context.retry_number > 0:
+        # pages kept from previous tries may predate this try
+        started_at = datetime.datetime.fromtimestamp(
+            context.instance.get_run_stats(context.run_id).start_time,
+            tz=LOCAL_TIME_ZONE,
+        )
+
+        # one listing for all pages written by previous tries
+        existing_keys = context.resources.file_manager._list_keys(
+            prefix=f"{table.name}/{file_stem}_p_"
+        )
+    else:
+        started_at = datetime.datetime.now(tz=LOCAL_TIME_ZONE)
+        existing_keys = set()
+
+    output_format = context.op_config["output_format"]
+
+    pages = []
+    for p in range(n_pages):
+        file_key = f"{table.name}/{file_stem}_p_{p}.{output_format}"
+
+        if file_key in existing_keys:
+            context.log.debug("File already exists from previous try. Skipping.")
+        else:
+            pages.append((p, file_key))
+
+    def _fetch(page_file_key):
+        page, file_key = page_file_key
+        data = fetch_page(
+            context=context,
+            table=table,
+            projection=projection,
+            query=query,
+            page=page,
+            n_pages=n_pages,
+        )
+        return file_key, data
+
+    if output_format == "parquet":
+        schema = get_table_schema(context=context, table=table, projection=projection)
+
+    def _serialize(file_key_data):
+        file_key, data = file_key_data
+        if output_format == "parquet":
+            return file_key, records_to_parquet(
+                context=context, records=data, table_name=table.name, schema=schema
+            )
+        elif output_format == "jsonl.gz":
+            return file_key, gzip.compress(
+                b"".join(json_dumps(r) + b"\n" for r in data),
+                mtime=0,
+            )
+        else:
+            return file_key, gzip.compress(json_dumps(data), mtime=0)
+
+    def _upload(file_key_obj):
+        file_key, obj = file_key_obj
+
+        if context.op_config["skip_unchanged"]:
+            file_handle, skipped = context.resources.file_manager.upload_if_changed(
+                obj=obj, file_key=file_key
+            )
+            return file_handle, (len(obj) if skipped else 0)
+        else:
+            file_handle = context.resources.file_manager.upload_from_string(
+                obj=obj, file_key=file_key
+            )
+            return file_handle, 0
+
+    if context.op_config["engine"] == "asyncio":
+        uploads = asyncio.run(
+            extract_pages_async(
+                context=context,
+                table=table,
+                projection=(
+                    projection
+                    if projection is not None
+                    else get_table_projection(context=context, table=table)
+                ),
+                query=query,
+                pages=pages,
+                n_pages=n_pages,
+                serialize=_serialize,
+            )
+        )
+    else:
+        # fetch -> serialize -> upload, overlapped with bounded queues between
+        # stages
+        uploads = run_pipeline(
+            items=pages,
+            stages=[
+                (_fetch, context.op_config["max_workers"]),
+                (_serialize, 1),
+                (_upload, context.op_config["upload_workers"]),
+            ],
+            queue_size=context.op_config["queue_size"],
+        )
+
+    gcs_file_handles = [file_handle for file_handle, _ in uploads]
+    skipped_bytes = sum(n_bytes for _, n_bytes in uploads)
+    if skipped_bytes:
+        context.log.info(f"Skipped {skipped_bytes} unchanged bytes for {file_stem}.")
+
+    if is_resync:
+        set_completed_resync(context=context, table_name=table.name, query=query)
+    elif mark_key is not None:
+        set_high_water_mark(
+            context=context,
+            table_name=table.name,
+            mark_key=mark_key,
+            high_water_mark=started_at,
+        )
+
+    return gcs_file_handles, skipped_bytes
+
+
+PA_TYPES = [
+    ("TIMESTAMP", pa.timestamp("s")),
+    ("DATE", pa.date32()),
+    ("INT", pa.int64()),
+    ("NUMBER", pa.float64()),
+    ("FLOAT", pa.float64()),
+    ("DOUBLE", pa.float64()),
+]
+TABLE_SCHEMAS = {}
+
+
+def get_arrow_type(column):
+    """Arrow type for a column in PowerSchool's schema metadata.
+
+    NUMBER columns with a scale of 0, e.g. `NUMBER(10)` or `NUMBER(10,0)`, are
+    integers and map to int64 so IDs keep their precision. Unknown types are
+    kept as strings.
+    """
+    column_type = str(column.get("type", "")).upper()
+
+    scale = column.get("scale")
+    match = re.search(r"NUMBER\(\s*\d+\s*(?:,\s*(-?\d+)\s*)?\)", column_type)
+    if match:
+        scale = match.group(1) or 0
+
+    if "NUMBER" in column_type and scale is not None and int(scale) == 0:
+        return pa.int64()
+
+    return next((t for k, t in PA_TYPES if k in column_type), pa.string())
+
+
+def get_table_schema(context, table, projection):
+    """Column names and Arrow types for a table projection, from the table's
+    schema metadata. Columns with unknown types are kept as strings.
+
+    Only fetched schemas are cached: a failed request raises, so the step's
+    retry policy can fetch it again.
+    """
+    if table.name not in TABLE_SCHEMAS:
+        with time_limit(context.op_config["query_timeout"]):
+            metadata = table.metadata()
+
+        columns = metadata.get("columns") or next(
+            v.get("columns", []) for v in metadata.values() if isinstance(v, dict)
+        )
+        TABLE_SCHEMAS[table.name] = {
+            c["name"].lower(): get_arrow_type(c) for c in columns
+        }
+
+    column_types = TABLE_SCHEMAS[table.name]
+    if projection and projection != "*":
+        column_names = [c.strip().lower() for c in projection.split(",")]
+    else:
+        column_names = list(column_types)
+
+    return [(c, column_types.get(c, pa.string())) for c in column_names]
+
+
+def to_arrow_string(value):
+    if value is None or isinstance(value, str):
+        return value
+    elif isinstance(value, (dict, list)):
+        return json_dumps(value).decode("utf-8")
+    else:
+        return str(value)
+
+
+def cast_or_null(column, arrow_type):
+    """Casts a string column to `arrow_type`, nulling values that don't parse.
+
+    Returns the column and the number of values that were nulled.
+    """
+    try:
+        return column.cast(arrow_type), 0
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        pass
+
+    def _cast(value):
+        # e.g. "1.0" in an integer column parses via float64
+        for via in [[], [pa.float64()]]:
+            try:
+                for t in via + [arrow_type]:
+                    value = value.cast(t)
+                return value.as_py()
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                continue
+        return None
+
+    values = [_cast(v) if v.is_valid else None for v in column]
+    n_nulled = sum(v is None for v in values) - column.null_count
+
+    return pa.array(values, type=arrow_type), n_nulled
+
+
+def records_to_parquet(context, records, table_name, schema):
+    """Unwraps PowerSchool's `tables.<name>` record envelope into typed columns
+    and returns the page as Parquet bytes.
+
+    Every page of a table is written with the same schema: each column in
+    `schema` gets its schema type, with values that don't parse written as
+    null, and columns missing from `schema` are kept as strings.
+    """
+    rows = [next(iter(r["tables"].values())) if "tables" in r else r for r in records]
+
+    column_names = [c for c, _ in schema]
+    for row in rows:
+        for c in row:
+            if c not in column_names:
+                column_names.append(c)
+    column_types = dict(schema)
+
+    columns = []
+    for c in column_names:
+        column = pa.array([to_arrow_string(row.get(c)) for row in rows], pa.string())
+
+        column, n_nulled = cast_or_null(column, column_types.get(c, pa.string()))
+        if n_nulled:
+            context.log.warning(
+                f"Wrote {n_nulled} unparseable {table_name}.{c} values as null."
+            )
+
+        columns.append(column)
+
+    buffer = pa.BufferOutputStream()
+    pq.write_table(
+        pa.Table.from_arrays(columns, names=column_names),
+        buffer,
+        compression="snappy",
+    )
+
+    return buffer.getvalue().to_pybytes()
+
+
+HIGH_WATER_MARKS_KEY = "_high_water_marks/{table_name}.json"
+
+
+def get_high_water_marks(context, table_name):
+    high_water_marks, _ = context.resources.file_manager.read_json(
+        file_key=HIGH_WATER_MARKS_KEY.format(table_name=table_name)
+    )
+
+    return high_water_marks or {}
+
+
+def get_mark_key(projection, query_id):
+    """Marks are keyed by projection and what the query is as configured: its
+    `q` string, `<selector>=<value>` for selector queries, or nothing for
+    whole-table extracts. Not by the composed expression, which changes from run
+    to run for e.g. `value: today`."""
+    return "|".join([projection or "", query_id])
+
+
+def get_watermark(high_water_marks, projection, query_id):
+    """Returns (mark_key, high-water mark ISO string or None)."""
+    mark_key = get_mark_key(projection=projection, query_id=query_id)
+    return mark_key, high_water_marks.get(mark_key)
+
+
+def parse_high_water_mark(high_water_mark):
+    if high_water_mark:
+        return datetime.datetime.fromisoformat(high_water_mark)
+    else:
+        return None
+
+
+def set_high_water_mark(context, table_name, mark_key, high_water_mark):
+    def _update(high_water_marks):
+        high_water_marks = high_water_marks or {}
+
+        # never move a mark backwards, e.g. when an older run finishes last
+        current = parse_high_water_mark(high_water_marks.get(mark_key))
+        if current is None or high_water_mark > current:
+            high_water_marks[mark_key] = high_water_mark.isoformat()
+
+        return high_water_marks
+
+    context.resources.file_manager.update_json(
+        file_key=HIGH_WATER_MARKS_KEY.format(table_name=table_name), update_fn=_update
+    )
+    context.log.debug(f"High-water mark for {table_name}:\t{high_water_mark}")
+
+
+GET_DATA_CONFIG = {
+    "query_timeout": Field(Float, is_required=False, default_value=30),
+    "max_workers": Field(Int, is_required=False, default_value=1),
+    "upload_workers": Field(Int, is_required=False, default_value=1),
+    "queue_size": Field(Int, is_required=False, default_value=2),
+    # pipeline: fetch, serialize and upload stages on thread pools
+    # asyncio: every page from one event loop, with max_workers pages in flight
+    "engine": Field(
+        Enum("ExtractEngine", [EnumValue("pipeline"), EnumValue("asyncio")]),
+        is_required=False,
+        default_value="pipeline",
+    ),
+    "output_format": Field(
+        Enum(
+            "OutputFormat",
+            [EnumValue("json.gz"), EnumValue("jsonl.gz"), EnumValue("parquet")],
+        ),
+        is_required=False,
+        default_value="json.gz",
+    ),
+    "page_retries": Field(Int, is_required=False, default_value=3),
+    "page_retry_delay": Field(Float, is_required=False, default_value=1),
+    "page_retry_max_delay": Field(Float, is_required=False, default_value=30),
+    # compares each page with the object already at its key, so it never skips
+    # pages of compacted tables, whose page objects are deleted
+    "skip_unchanged": Field(Bool, is_required=False, default_value=True),
+}
 
 
 @op(
     ins={
-        "table": In(dagster_type=Any),
+        "table_name": In(dagster_type=String),
         "projection": In(dagster_type=Optional[String]),
         "query": In(dagster_type=Optional[String]),
         "n_pages": In(dagster_type=Int),
+        "is_resync": In(dagster_type=Bool, default_value=False),
+        "mark_key": In(dagster_type=Optional[String], default_value=None),
     },
     out={"gcs_file_handles": Out(dagster_type=List)},
-    required_resource_keys={"file_manager"},
+    required_resource_keys={"powerschool", "file_manager"},
     retry_policy=RetryPolicy(
         max_retries=5, delay=30, backoff=Backoff.EXPONENTIAL, jitter=Jitter.PLUS_MINUS
     ),
-    config_schema={"query_timeout": Field(Int, is_required=False, default_value=30)},
+    config_schema=GET_DATA_CONFIG,
     tags={"dagster/priority": 6},
 )
-def get_data(context, table, projection, query, n_pages):
+def get_data(context, table_name, projection, query, n_pages, is_resync, mark_key):
     context.log.debug(
-        f"table:\t\t{table.name}\nprojection:\t{projection}\nq:\t\t{query}"
+        f"table:\t\t{table_name}\nprojection:\t{projection}\nq:\t\t{query}"
     )
 
-    file_stem = "_".join(filter(None, [table.name, str(query or "")]))
+    table = context.resources.powerschool.get_schema_table(table_name)
 
-    gcs_file_handles = []
-    for p in range(n_pages):
-        file_key = f"{table.name}/{file_stem}_p_{p}.json.gz"
+    gcs_file_handles, skipped_bytes = extract_query(
+        context=context,
+        table=table,
+        projection=projection,
+        query=query,
+        n_pages=n_pages,
+        is_resync=is_resync,
+        mark_key=mark_key,
+    )
 
-        if context.retry_number > 0 and context.resources.file_manager._has_object(
-            key=file_key
-        ):
-            context.log.debug("File already exists from previous try. Skipping.")
-        else:
-            context.log.debug(f"page:\t{(p + 1)}/{n_pages}")
+    return Output(
+        value=gcs_file_handles,
+        output_name="gcs_file_handles",
+        metadata={"skipped_bytes": skipped_bytes},
+    )
+
+
+@op(
+    ins={"batch_queries": In(dagster_type=List[Tuple])},
+    out={"gcs_file_handles": Out(dagster_type=List)},
+    required_resource_keys={"powerschool", "file_manager"},
+    retry_policy=RetryPolicy(
+        max_retries=5, delay=30, backoff=Backoff.EXPONENTIAL, jitter=Jitter.PLUS_MINUS
+    ),
+    config_schema=merge_dicts(
+        GET_DATA_CONFIG,
+        {"max_concurrent": Field(Int, is_required=False, default_value=10)},
+    ),
+    tags={"dagster/priority": 6},
+)
+def get_data_batch(context, batch_queries):
+    context.log.info(f"Extracting {len(batch_queries)} queries in one step.")
+
+    def _extract(batch_query):
+        table_name, projection, query, n_pages, is_resync, mark_key = batch_query
+        context.log.debug(
+            f"table:\t\t{table_name}\nprojection:\t{projection}\nq:\t\t{query}"
+        )
+
+        return extract_query(
+            context=context,
+            table=context.resources.powerschool.get_schema_table(table_name),
+            projection=projection,
+            query=query,
+            n_pages=n_pages,
+            is_resync=is_resync,
+            mark_key=mark_key,
+        )
+
+    with ThreadPoolExecutor(max_workers=context.op_config["max_concurrent"]) as ex:
+        extracts = list(ex.map(_extract, batch_queries))
+
+    return Output(
+        value=[fh for fhs, _ in extracts for fh in fhs],
+        output_name="gcs_file_handles",
+        metadata={"skipped_bytes": sum(n_bytes for _, n_bytes in extracts)},
+    )
+
+
+@op(
+    ins={"planned_query": In(dagster_type=Tuple)},
+    out={"gcs_file_handles": Out(dagster_type=List)},
+    required_resource_keys={"powerschool", "file_manager"},
+    retry_policy=RetryPolicy(
+        max_retries=5, delay=30, backoff=Backoff.EXPONENTIAL, jitter=Jitter.PLUS_MINUS
+    ),
+    config_schema=GET_DATA_CONFIG,
+    tags={"dagster/priority": 6},
+)
+def get_data_planned(context, planned_query):
+    table_name, projection, query, n_pages, is_resync, mark_key = planned_query
+    context.log.debug(
+        f"table:\t\t{table_name}\nprojection:\t{projection}\nq:\t\t{query}"
+    )
+
+    gcs_file_handles, skipped_bytes = extract_query(
+        context=context,
+        table=context.resources.powerschool.get_schema_table(table_name),
+        projection=projection,
+        query=query,
+        n_pages=n_pages,
+        is_resync=is_resync,
+        mark_key=mark_key,
+    )
+
+    return Output(
+        value=gcs_file_handles,
+        output_name="gcs_file_handles",
+        metadata={"skipped_bytes": skipped_bytes},
+    )
+
+
+# page files are {stem}_p_{n}, compacted objects {stem}_c_{first}_{last}
+PAGE_KEY_PATTERN = re.compile(
+    r"^(?P<stem>.+)_(?P<kind>[pc])_(?P<n>\d+)(?:_(?P<last>\d+))?"
+    r"\.(?P<suffix>json\.gz|jsonl\.gz|parquet)$"
+)
+
+
+def unify_page_schemas(schemas):
+    """Merges page schemas by column name, in first-seen order.
+
+    Columns whose types differ between pages take their common supertype,
+    e.g. int64 and float64 become float64, or string if they have none.
+    """
+    fields = {}
+    for schema in schemas:
+        for field in schema:
+            arrow_type = fields.setdefault(field.name, field.type)
+            if arrow_type == field.type:
+                continue
 
             try:
-                data = time_limit_query(
-                    context=context,
-                    table=table,
-                    query=query,
-                    projection=projection,
-                    page=(p + 1),
+                fields[field.name] = (
+                    pa.unify_schemas(
+                        [
+                            pa.schema([(field.name, arrow_type)]),
+                            pa.schema([field]),
+                        ],
+                        promote_options="permissive",
+                    )
+                    .field(0)
+                    .type
                 )
-            except Exception as e:
-                raise RetryRequested(
-                    max_retries=context.op_def.retry_policy.max_retries,
-                    seconds_to_wait=context.op_def.retry_policy.delay,
-                ) from e
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                fields[field.name] = pa.string()
+
+    return pa.schema(list(fields.items()))
+
+
+def conform_table(table, schema):
+    return pa.Table.from_arrays(
+        [
+            table.column(f.name).cast(f.type)
+            if f.name in table.column_names
+            else pa.nulls(len(table), type=f.type)
+            for f in schema
+        ],
+        schema=schema,
+    )
+
+
+def merge_objects(context, keys, suffix, file_key):
+    """Merges page objects into `file_key`, one page at a time.
+
+    The merged object is streamed to GCS, so memory is bounded by the largest
+    page rather than the group. Parquet pages become row groups of one file
+    whose schema is the union of the pages' schemas. json.gz pages are spliced
+    into one JSON array without being parsed.
+    """
+    file_manager = context.resources.file_manager
+
+    if suffix == "parquet":
+        # footers only, read with ranged requests
+        schemas = []
+        for key in keys:
+            with file_manager.open_reader(file_key=key) as f:
+                schemas.append(pq.read_schema(f))
+        schema = unify_page_schemas(schemas)
+
+        with file_manager.open_writer(file_key=file_key) as f:
+            with pq.ParquetWriter(f, schema=schema, compression="snappy") as writer:
+                for key in keys:
+                    with file_manager.open_reader(file_key=key) as page:
+                        table = pq.read_table(page)
+                    writer.write_table(conform_table(table=table, schema=schema))
+
+            return f.file_handle
+    else:
+        with file_manager.open_writer(file_key=file_key) as f:
+            with gzip.GzipFile(fileobj=f, mode="wb", mtime=0) as gz:
+                gz.write(b"[")
+
+                is_empty = True
+                for key in keys:
+                    # each page is one JSON array: write its elements
+                    elements = gzip.decompress(
+                        file_manager.download_as_bytes(
+                            file_handle=GCSFileHandle(
+                                file_manager._gcs_bucket, file_manager.get_full_key(key)
+                            )
+                        )
+                    ).strip()[1:-1]
+                    if not elements.strip():
+                        continue
+
+                    if not is_empty:
+                        gz.write(b",")
+                    gz.write(elements)
+                    is_empty = False
+
+                gz.write(b"]")
+
+            return f.file_handle
+
+
+def compact_query_files(context, stem, suffix):
+    """Merges a query's page files into objects of about `target_size` bytes.
 
+    Compacted objects are named by the pages they hold, so a rerun after a
+    partial failure keeps the objects already written and only compacts the
+    pages that are left. When page 0 exists the pages are a new extract, and
+    every compacted object is stale. Stale objects are deleted before anything
+    is written, while the pages still hold their records.
+    """
+    file_manager = context.resources.file_manager
+    target_size = context.op_config["target_size"]
+
+    pages = []
+    compacted = []
+    for key, size in file_manager._list_sizes(prefix=f"{stem}_").items():
+        match = PAGE_KEY_PATTERN.match(key)
+        if match is None or match["stem"] != stem or match["suffix"] != suffix:
+            continue
+        elif match["kind"] == "p" and match["last"] is None:
+            pages.append((int(match["n"]), key, size))
+        elif match["kind"] == "c" and match["last"] is not None:
+            compacted.append((int(match["n"]), int(match["last"]), key))
+    pages.sort()
+    compacted.sort()
+
+    page_numbers = [n for n, _, _ in pages]
+    stale_keys = [
+        key
+        for first, last, key in compacted
+        if 0 in page_numbers or any(first <= n <= last for n in page_numbers)
+    ]
+    if stale_keys:
+        file_manager._rm_keys(keys=stale_keys)
+
+    groups = []
+    for n, key, size in pages:
+        if groups and groups[-1][2] + size <= target_size:
+            groups[-1][1].append(key)
+            groups[-1][2] += size
+            groups[-1][3] = n
+        else:
+            groups.append([n, [key], size, n])
+
+    gcs_file_handles = [
+        GCSFileHandle(file_manager._gcs_bucket, file_manager.get_full_key(key))
+        for _, _, key in compacted
+        if key not in stale_keys
+    ]
+    for first, keys, _, last in groups:
+        if len(keys) == 1:
             gcs_file_handles.append(
-                context.resources.file_manager.upload_from_string(
-                    obj=gzip.compress(json.dumps(data).encode("utf-8")),
-                    file_key=file_key,
+                GCSFileHandle(
+                    file_manager._gcs_bucket, file_manager.get_full_key(keys[0])
                 )
             )
+            continue
+
+        file_key = f"{stem}_c_{first}_{last}.{suffix}"
+        if suffix == "jsonl.gz":
+            # concatenated gzip members are a valid gzip stream
+            file_handle = file_manager.compose(source_keys=keys, file_key=file_key)
+        else:
+            file_handle = merge_objects(
+                context=context, keys=keys, suffix=suffix, file_key=file_key
+            )
+
+        # pages are only removed once the compacted object is in place
+        file_manager._rm_keys(keys=keys)
+        gcs_file_handles.append(file_handle)
+
+    context.log.info(
+        f"Compacted {len(pages)} pages of {stem}.{suffix} into "
+        f"{len(gcs_file_handles)} objects."
+    )
+
+    return gcs_file_handles
+
+
+@op(
+    ins={"gcs_file_handles": In(dagster_type=List)},
+    out={"gcs_file_handles": Out(dagster_type=List)},
+    required_resource_keys={"file_manager"},
+    config_schema={
+        "target_size": Field(Int, is_required=False, default_value=256 * 1024**2),
+    },
+    tags={"dagster/priority": 7},
+)
+def compact_files(context, gcs_file_handles):
+    base_key_len = len(context.resources.file_manager.get_full_key(""))
+
+    stem_suffixes = []
+    for file_handle in gcs_file_handles:
+        match = PAGE_KEY_PATTERN.match(file_handle.gcs_key[base_key_len:])
+        if match and (match["stem"], match["suffix"]) not in stem_suffixes:
+            stem_suffixes.append((match["stem"], match["suffix"]))
+
+    compacted_file_handles = []
+    for stem, suffix in stem_suffixes:
+        compacted_file_handles.extend(
+            compact_query_files(context=context, stem=stem, suffix=suffix)
+        )
 
-    return Output(value=gcs_file_handles, output_name="gcs_file_handles")
+    return Output(value=compacted_file_handles, output_name="gcs_file_handles")
@@ -1,10 +1,14 @@
 import gzip
+import hashlib
 import json
+import threading
 import uuid
+from contextlib import contextmanager
 
+import aiohttp
 import google.auth
 import gspread
-from dagster import DagsterEventType, Field, String, StringSource
+from dagster import DagsterEventType, Enum, EnumValue, Field, String, StringSource
 from dagster import _check as check
 from dagster import io_manager, resource
 from dagster.utils.backoff import backoff
@@ -13,7 +17,55 @@ from dagster_gcp import GCSFileHandle
 from dagster_gcp.gcs.file_manager import GCSFileManager
 from dagster_gcp.gcs.io_manager import PickledObjectGCSIOManager
 from dagster_gcp.gcs.resources import GCS_CLIENT_CONFIG, _gcs_client_from_config
-from google.api_core.exceptions import Forbidden, TooManyRequests
+from google.api_core.exceptions import Forbidden, PreconditionFailed, TooManyRequests
+
+
+class StepOutputFileKeyIndex(object):
+    """Maps (step_key, output_name, mapping_key) to `file_key` output metadata.
+
+    STEP_OUTPUT events are read incrementally with a per-run cursor, so each
+    event is read once per process and lookups are dict hits. The index only
+    lives as long as the process: under the multiprocess executor each step
+    process reads the run's STEP_OUTPUT events once, as it did before the index,
+    and only steps in the same process share them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._runs = {}
+
+    def _refresh(self, instance, run_id):
+        cursor, file_keys = self._runs.setdefault(run_id, (-1, {}))
+
+        logs = instance.logs_after(run_id, cursor, of_type=DagsterEventType.STEP_OUTPUT)
+        for log in logs:
+            event_data = log.dagster_event.event_specific_data
+            output_handle = event_data.step_output_handle
+
+            file_key_entry = next(
+                (e for e in event_data.metadata_entries if e.label == "file_key"),
+                None,
+            )
+
+            file_keys[
+                (log.step_key, output_handle.output_name, output_handle.mapping_key)
+            ] = (file_key_entry.value.text if file_key_entry else None)
+
+        self._runs[run_id] = (cursor + len(logs), file_keys)
+
+    def get(self, instance, run_id, step_key, output_name, mapping_key=None):
+        key = (step_key, output_name, mapping_key)
+
+        with self._lock:
+            file_keys = self._runs.get(run_id, (-1, {}))[1]
+            if key not in file_keys:
+                self._refresh(instance=instance, run_id=run_id)
+                file_keys = self._runs[run_id][1]
+
+            return file_keys.get(key)
+
+
+STEP_OUTPUT_FILE_KEYS = StepOutputFileKeyIndex()
 
 
 class GCSIOManager(PickledObjectGCSIOManager):
@@ -21,29 +73,13 @@ class GCSIOManager(PickledObjectGCSIOManager):
         super().__init__(bucket, client, prefix)
 
     def _get_file_key(self, context):
-        all_output_logs = context.step_context.instance.all_logs(
-            context.run_id, of_type=DagsterEventType.STEP_OUTPUT
-        )
-
-        step_output_log = (
-            [log for log in all_output_logs if log.step_key == context.step_key][0]
-            if all_output_logs
-            else None
+        return STEP_OUTPUT_FILE_KEYS.get(
+            instance=context.step_context.instance,
+            run_id=context.run_id,
+            step_key=context.step_key,
+            output_name=context.name,
+            mapping_key=context.mapping_key,
         )
-        if step_output_log:
-            metadata = (
-                step_output_log.dagster_event.event_specific_data.metadata_entries
-            )
-        else:
-            return None
-
-        file_key_entry = (
-            [e for e in metadata if e.label == "file_key"][0] if metadata else None
-        )
-        if file_key_entry:
-            return file_key_entry.value.text
-        else:
-            return None
 
     def _get_path(self, context):
         if context.file_key:
@@ -98,11 +134,47 @@ def gcs_io_manager(context):
     )
 
 
+CONTENT_HASH_KEY = "content_sha256"
+
+
+def get_content_hash(obj):
+    if isinstance(obj, str):
+        obj = obj.encode("utf-8")
+
+    return hashlib.sha256(obj).hexdigest()
+
+
+class HashingWriter(object):
+    """Forwards writes to `fileobj`, hashing and counting the bytes written."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hash = hashlib.sha256()
+        self.n_bytes = 0
+        self.file_handle = None
+
+    def write(self, b):
+        self.hash.update(b)
+        self.n_bytes += len(b)
+        return self.fileobj.write(b)
+
+    def flush(self):
+        pass
+
+    def tell(self):
+        return self.n_bytes
+
+    @property
+    def closed(self):
+        return False
+
+
 class GCSFileManager(GCSFileManager):
-    def __init__(self, client, gcs_bucket, gcs_base_key, logger):
+    def __init__(self, client, gcs_bucket, gcs_base_key, logger, upload_mode="replace"):
         super().__init__(client, gcs_bucket, gcs_base_key)
         self.bucket_obj = self._client.bucket(self._gcs_bucket)
         self.log = logger
+        self.upload_mode = upload_mode
 
     def _rm_object(self, key):
         check.str_param(key, "key")
@@ -115,38 +187,279 @@ class GCSFileManager(GCSFileManager):
         check.str_param(key, "key")
         check.param_invariant(len(key) > 0, "key")
 
-        key = self.get_full_key(key)
-        blobs = self._client.list_blobs(self._gcs_bucket, prefix=key)
+        blobs = self._client.list_blobs(self._gcs_bucket, prefix=key, max_results=1)
+
+        return next(iter(blobs), None) is not None
+
+    def _list_keys(self, prefix):
+        """Returns every key under `prefix`, relative to the base key, from a
+        single prefix listing."""
+        return set(self._list_sizes(prefix=prefix))
+
+    def _list_sizes(self, prefix):
+        """Returns {key: size in bytes} for every key under `prefix`, relative to
+        the base key, from a single prefix listing."""
+        check.str_param(prefix, "prefix")
+
+        full_prefix = self.get_full_key(prefix)
+        base_key_len = len(full_prefix) - len(prefix)
+
+        blobs = self._client.list_blobs(self._gcs_bucket, prefix=full_prefix)
 
-        return len(list(blobs)) > 0
+        return {blob.name[base_key_len:]: blob.size for blob in blobs}
+
+    def _rm_keys(self, keys):
+        self.bucket_obj.delete_blobs(
+            blobs=[self.get_full_key(key) for key in keys], on_error=lambda blob: None
+        )
 
     def _uri_for_key(self, key):
         check.str_param(key, "key")
         return f"gs://{self._gcs_bucket}/{key}"
 
-    def upload_from_string(self, obj, ext=None, file_key=None):
+    def upload_from_string(
+        self,
+        obj,
+        ext=None,
+        file_key=None,
+        mode=None,
+        if_generation_match=None,
+        metadata=None,
+    ):
+        """Uploads `obj` to GCS.
+
+        mode:
+            replace: remove any existing object before uploading (legacy)
+            overwrite: single request, replacing any live object atomically
+            create: single request, fails with PreconditionFailed if the key exists
+
+        `if_generation_match` makes the upload conditional on the live object's
+        generation, e.g. for read-modify-write updates.
+        """
+        mode = mode or self.upload_mode
         key = self.get_full_key(
             file_key or (str(uuid.uuid4()) + (("." + ext) if ext is not None else ""))
         )
 
         self.log.debug(f"Writing GCS object at: {self._uri_for_key(key=key)}")
 
-        if self._has_object(key):
+        if mode == "replace" and self._has_object(key):
             self.log.warning(f"Removing existing GCS key: {key}")
             self._rm_object(key)
 
+        if if_generation_match is None and mode == "create":
+            if_generation_match = 0
+
+        blob = self.bucket_obj.blob(key)
+        blob.metadata = metadata
+
         backoff(
-            self.bucket_obj.blob(key).upload_from_string,
+            blob.upload_from_string,
             args=[obj],
+            kwargs=(
+                {"if_generation_match": if_generation_match}
+                if if_generation_match is not None
+                else {}
+            ),
             retry_on=(TooManyRequests, Forbidden),
         )
 
         return GCSFileHandle(self._gcs_bucket, key)
 
+    def upload_if_changed(self, obj, file_key, mode=None):
+        """Uploads `obj` unless the object at `file_key` already holds the same
+        content, as recorded by its `content_sha256` metadata.
+
+        Returns (file_handle, skipped).
+        """
+        content_hash = get_content_hash(obj)
+        key = self.get_full_key(file_key)
+
+        blob = self.bucket_obj.get_blob(key)
+        if (
+            blob is not None
+            and (blob.metadata or {}).get(CONTENT_HASH_KEY) == content_hash
+        ):
+            self.log.debug(f"Unchanged GCS object at: {self._uri_for_key(key=key)}")
+            return GCSFileHandle(self._gcs_bucket, key), True
+
+        file_handle = self.upload_from_string(
+            obj=obj,
+            file_key=file_key,
+            mode=mode,
+            metadata={CONTENT_HASH_KEY: content_hash},
+        )
+
+        return file_handle, False
+
+    async def upload_async(self, storage, obj, file_key, skip_unchanged=False):
+        """Uploads `obj` through a gcloud-aio `Storage` client, for callers on an
+        event loop.
+
+        Each upload is a single request that replaces any live object, as in
+        `overwrite` mode, and records the content hash as `upload_if_changed`
+        does. With `skip_unchanged`, objects that already hold the same content
+        are not uploaded again.
+
+        Returns (file_handle, skipped).
+        """
+        content_hash = get_content_hash(obj)
+        key = self.get_full_key(file_key)
+
+        if skip_unchanged:
+            try:
+                resource = await storage.download_metadata(self._gcs_bucket, key)
+            except aiohttp.ClientResponseError as e:
+                if e.status != 404:
+                    raise e
+                resource = {}
+
+            if (resource.get("metadata") or {}).get(CONTENT_HASH_KEY) == content_hash:
+                self.log.debug(f"Unchanged GCS object at: {self._uri_for_key(key=key)}")
+                return GCSFileHandle(self._gcs_bucket, key), True
+
+        self.log.debug(f"Writing GCS object at: {self._uri_for_key(key=key)}")
+
+        await storage.upload(
+            self._gcs_bucket,
+            key,
+            obj,
+            content_type="application/octet-stream",
+            metadata={"metadata": {CONTENT_HASH_KEY: content_hash}},
+        )
+
+        return GCSFileHandle(self._gcs_bucket, key), False
+
+    @contextmanager
+    def open_writer(self, file_key, chunk_size=None):
+        """Yields a binary file object that streams to `file_key` through a
+        resumable upload, so the object never has to be held in memory.
+
+        The object is only finalized if the block exits cleanly; on error the
+        upload is abandoned and any live object is left untouched. Its content
+        hash is recorded as for `upload_if_changed`, and if the content is
+        unchanged the previous object's metadata is carried over.
+        """
+        key = self.get_full_key(file_key)
+        self.log.debug(f"Streaming GCS object to: {self._uri_for_key(key=key)}")
+
+        previous_blob = self.bucket_obj.get_blob(key)
+        previous_metadata = (
+            (previous_blob.metadata or {}) if previous_blob is not None else {}
+        )
+
+        blob = self.bucket_obj.blob(key)
+        blob_writer = blob.open("wb", chunk_size=chunk_size, ignore_flush=True)
+
+        writer = HashingWriter(blob_writer)
+        writer.file_handle = GCSFileHandle(self._gcs_bucket, key)
+
+        yield writer
+
+        blob_writer.close()
+
+        content_hash = writer.hash.hexdigest()
+        if previous_metadata.get(CONTENT_HASH_KEY) == content_hash:
+            blob.metadata = previous_metadata
+        else:
+            blob.metadata = {CONTENT_HASH_KEY: content_hash}
+        blob.patch()
+
+    def get_blob(self, file_handle):
+        """Returns the object's Blob, with size and metadata, or None."""
+        bucket_obj = self._client.bucket(file_handle.gcs_bucket)
+        return bucket_obj.get_blob(file_handle.gcs_key)
+
+    def update_metadata(self, file_handle, metadata):
+        """Merges `metadata` into the object's existing custom metadata."""
+        bucket_obj = self._client.bucket(file_handle.gcs_bucket)
+
+        blob = bucket_obj.blob(file_handle.gcs_key)
+        blob.metadata = metadata
+        blob.patch()
+
+    def compose(self, source_keys, file_key):
+        """Concatenates `source_keys` into `file_key` server-side.
+
+        GCS composes at most 32 objects per request, so longer lists are composed
+        in rounds through temporary objects.
+        """
+        sources = [self.bucket_obj.blob(self.get_full_key(k)) for k in source_keys]
+        intermediates = []
+
+        while len(sources) > 32:
+            next_sources = []
+            for i in range(0, len(sources), 32):
+                chunk = sources[i : i + 32]
+                if len(chunk) == 1:
+                    next_sources.extend(chunk)
+                    continue
+
+                intermediate = self.bucket_obj.blob(
+                    self.get_full_key(f"_compose/{uuid.uuid4()}")
+                )
+                backoff(
+                    intermediate.compose,
+                    args=[chunk],
+                    retry_on=(TooManyRequests, Forbidden),
+                )
+
+                intermediates.append(intermediate)
+                next_sources.append(intermediate)
+            sources = next_sources
+
+        key = self.get_full_key(file_key)
+        self.log.debug(f"Composing GCS object at: {self._uri_for_key(key=key)}")
+
+        backoff(
+            self.bucket_obj.blob(key).compose,
+            args=[sources],
+            retry_on=(TooManyRequests, Forbidden),
+        )
+
+        if intermediates:
+            self.bucket_obj.delete_blobs(
+                blobs=intermediates, on_error=lambda blob: None
+            )
+
+        return GCSFileHandle(self._gcs_bucket, key)
+
     def download_as_bytes(self, file_handle):
         bucket_obj = self._client.bucket(file_handle.gcs_bucket)
         return bucket_obj.blob(file_handle.gcs_key).download_as_bytes()
 
+    def open_reader(self, file_key):
+        """Returns a seekable binary file object that reads `file_key` in ranged
+        requests, e.g. to read a Parquet footer without downloading the file."""
+        return self.bucket_obj.blob(self.get_full_key(file_key)).open("rb")
+
+    def read_json(self, file_key):
+        """Returns (obj, generation), or (None, 0) if the key does not exist."""
+        blob = self.bucket_obj.get_blob(self.get_full_key(file_key))
+        if blob is None:
+            return None, 0
+
+        obj = json.loads(blob.download_as_bytes(if_generation_match=blob.generation))
+
+        return obj, blob.generation
+
+    def update_json(self, file_key, update_fn, max_attempts=5):
+        """Read-modify-write of a JSON object, guarded by a generation
+        precondition so concurrent writers never overwrite each other."""
+        for attempt in range(max_attempts):
+            obj, generation = self.read_json(file_key)
+            try:
+                return self.upload_from_string(
+                    obj=json.dumps(update_fn(obj)),
+                    file_key=file_key,
+                    mode="overwrite",
+                    if_generation_match=generation,
+                )
+            except PreconditionFailed as e:
+                if attempt + 1 == max_attempts:
+                    raise e
+                self.log.debug(f"{file_key} changed while updating. Retrying.")
+
 
 @resource(
     config_schema=merge_dicts(
@@ -156,6 +469,18 @@ class GCSFileManager(GCSFileManager):
             "gcs_prefix": Field(
                 StringSource, is_required=False, default_value="dagster"
             ),
+            "upload_mode": Field(
+                Enum(
+                    "GCSUploadMode",
+                    [
+                        EnumValue("replace"),
+                        EnumValue("overwrite"),
+                        EnumValue("create"),
+                    ],
+                ),
+                is_required=False,
+                default_value="replace",
+            ),
         },
     )
 )
@@ -169,6 +494,7 @@ def gcs_file_manager(context):
         gcs_bucket=context.resource_config["gcs_bucket"],
         gcs_base_key=context.resource_config["gcs_prefix"],
         logger=context.log,
+        upload_mode=context.resource_config["upload_mode"],
     )
 
 
@@ -1,5 +1,315 @@
-from dagster import StringSource, resource
+import asyncio
+import threading
+import time
+
+import aiohttp
+import orjson
+from dagster import Bool, Field, Float, Int, StringSource, resource
 from powerschool import PowerSchool
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, HTTPError, Timeout
+from urllib3.exceptions import ReadTimeoutError
+
+from teamster.common.utils import remaining_time
+
+
+class AdaptiveRateLimiter(object):
+    """Shared concurrency limit and token bucket for one PowerSchool host.
+
+    Both adapt AIMD-style: every healthy response raises the limits additively,
+    a 429/5xx response, timeout or connection error cuts them in half, and a 429
+    `Retry-After` pauses all callers. Like TCP, the limits are cut at most once
+    per round trip: requests already in flight when the limits were cut were
+    sent under the old limits, so their failures are not counted again.
+    """
+
+    def __init__(self, max_concurrency, min_concurrency=1, max_rate=0.0):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_rate = max_rate
+
+        self.concurrency = float(max_concurrency)
+        self.rate = float(max_rate)
+        self.tokens = 1.0
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.updated_at = time.monotonic()
+        self.last_decrease_at = None
+
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        if self.rate:
+            self.tokens = min(
+                max(self.rate, 1.0), self.tokens + (now - self.updated_at) * self.rate
+            )
+        self.updated_at = now
+
+    def _wait_time(self, now):
+        if now < self.paused_until:
+            return self.paused_until - now
+        elif self.in_flight >= int(self.concurrency):
+            # woken up by release()
+            return None
+        elif self.rate and self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+        else:
+            return 0
+
+    def acquire(self):
+        """Blocks until a request may be sent and returns when it was allowed
+        to, to pass back to `release()`."""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+
+                wait_time = self._wait_time(now)
+                if wait_time == 0:
+                    break
+
+                remaining = remaining_time()
+                if remaining is not None:
+                    wait_time = min(wait_time or remaining, remaining)
+                self._cond.wait(timeout=wait_time)
+
+            return self._take(now)
+
+    async def acquire_async(self, poll_interval=0.05):
+        """`acquire()` for coroutines, waiting without blocking the event loop.
+
+        `release()` can't wake a coroutine, so while every slot is taken it
+        checks again every `poll_interval` seconds.
+        """
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                self._refill(now)
+
+                wait_time = self._wait_time(now)
+                if wait_time == 0:
+                    return self._take(now)
+
+            await asyncio.sleep(poll_interval if wait_time is None else wait_time)
+
+    def _take(self, now):
+        self.in_flight += 1
+        if self.rate:
+            self.tokens -= 1
+
+        return now
+
+    def release(self, healthy, retry_after=None, sent_at=None):
+        with self._cond:
+            self.in_flight -= 1
+
+            if healthy:
+                self.concurrency = min(
+                    self.max_concurrency, self.concurrency + 1 / self.concurrency
+                )
+                if self.max_rate:
+                    self.rate = min(self.max_rate, self.rate + 1 / max(self.rate, 1))
+            elif (
+                sent_at is None
+                or self.last_decrease_at is None
+                or sent_at > self.last_decrease_at
+            ):
+                # requests sent before the last decrease were already paid for
+                self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+                if self.max_rate:
+                    self.rate = max(1.0, self.rate / 2)
+                self.last_decrease_at = time.monotonic()
+
+            if retry_after:
+                self.paused_until = max(
+                    self.paused_until, time.monotonic() + retry_after
+                )
+
+            self._cond.notify_all()
+
+
+RATE_LIMITERS = {}
+RATE_LIMITERS_LOCK = threading.Lock()
+
+
+def get_rate_limiter(host, **kwargs):
+    """One limiter per host, shared by every client in the process."""
+    with RATE_LIMITERS_LOCK:
+        if host not in RATE_LIMITERS:
+            RATE_LIMITERS[host] = AdaptiveRateLimiter(**kwargs)
+        return RATE_LIMITERS[host]
+
+
+def parse_retry_after(response):
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+class DeadlineHTTPAdapter(HTTPAdapter):
+    """Bounds each request by the caller's `time_limit` deadline and routes it
+    through the host's rate limiter.
+
+    `requests` timeouts only apply to each connect or socket read, so the
+    adapter also reads the body itself and checks the deadline between chunks,
+    and every request made under the same deadline shares it. A call can
+    therefore overrun its deadline by at most one blocking read.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, rate_limiter=None, **kwargs):
+        super().__init__(**kwargs)
+        self.rate_limiter = rate_limiter
+
+    def send(self, request, timeout=None, **kwargs):
+        if self.rate_limiter is None:
+            return self._send(request, timeout=timeout, **kwargs)
+
+        sent_at = self.rate_limiter.acquire()
+        try:
+            response = self._send(request, timeout=timeout, **kwargs)
+        except (TimeoutError, Timeout, ConnectionError) as e:
+            self.rate_limiter.release(healthy=False, sent_at=sent_at)
+            raise e
+        except Exception as e:
+            self.rate_limiter.release(healthy=True, sent_at=sent_at)
+            raise e
+
+        if response.status_code == 429 or response.status_code >= 500:
+            self.rate_limiter.release(
+                healthy=False,
+                retry_after=parse_retry_after(response),
+                sent_at=sent_at,
+            )
+        else:
+            self.rate_limiter.release(healthy=True, sent_at=sent_at)
+
+        return response
+
+    def _send(self, request, timeout=None, stream=False, **kwargs):
+        remaining = remaining_time()
+        if remaining is None:
+            return super().send(request, timeout=timeout, stream=stream, **kwargs)
+
+        if isinstance(timeout, tuple):
+            timeout = tuple(min(t or remaining, remaining) for t in timeout)
+        else:
+            timeout = min(timeout or remaining, remaining)
+
+        try:
+            response = super().send(request, timeout=timeout, stream=True, **kwargs)
+        except Timeout as e:
+            raise TimeoutError(f"Timed out after {remaining:.3f}s") from e
+
+        if stream:
+            return response
+
+        try:
+            chunks = []
+            for chunk in response.iter_content(chunk_size=self.chunk_size):
+                remaining_time()
+                chunks.append(chunk)
+        except ConnectionError as e:
+            response.close()
+            if e.args and isinstance(e.args[0], ReadTimeoutError):
+                raise TimeoutError(f"Timed out after {remaining:.3f}s") from e
+            raise e
+        except TimeoutError as e:
+            response.close()
+            raise e
+
+        # what Response.content does when the body is read without streaming
+        response._content = b"".join(chunks)
+        response._content_consumed = True
+
+        return response
+
+
+class AsyncPowerSchool(object):
+    """Schema table page queries over an aiohttp session, so many pages can be
+    in flight from one thread.
+
+    Sends the authorized client's OAuth token through the host's rate limiter,
+    and raises HTTP errors as the client does: `HTTPError(body)` raised while
+    handling the original error, which carries the status code.
+    """
+
+    def __init__(self, client, session):
+        self.client = client
+        self.session = session
+        self.rate_limiter = RATE_LIMITERS.get(client.host)
+        self.headers = {
+            k: v
+            for k, v in client.session.headers.items()
+            if k in ["Accept", "Authorization"]
+        }
+
+    async def query(self, table_name, q=None, projection=None, page=None):
+        params = {
+            "q": q,
+            "projection": projection,
+            "page": page,
+            "pagesize": self.client.metadata.schema_table_query_max_page_size,
+        }
+
+        sent_at = await self.rate_limiter.acquire_async() if self.rate_limiter else None
+        healthy = True
+        retry_after = None
+        try:
+            async with self.session.get(
+                f"{self.client.base_url}/ws/schema/table/{table_name}",
+                params={k: str(v) for k, v in params.items() if v is not None},
+                headers=self.headers,
+            ) as response:
+                body = await response.read()
+
+                if response.status == 429 or response.status >= 500:
+                    healthy = False
+                    retry_after = parse_retry_after(response)
+
+                try:
+                    response.raise_for_status()
+                except aiohttp.ClientResponseError:
+                    raise HTTPError(body.decode("utf-8", errors="replace"))
+        except (asyncio.CancelledError, asyncio.TimeoutError, aiohttp.ClientError):
+            # timed out, cancelled or dropped
+            healthy = False
+            raise
+        finally:
+            if self.rate_limiter:
+                self.rate_limiter.release(
+                    healthy=healthy, retry_after=retry_after, sent_at=sent_at
+                )
+
+        records = orjson.loads(body).get("record") or []
+
+        return [r.get("tables").get(table_name) for r in records]
+
+
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+
+
+def get_client(host, client_id, client_secret, client_ttl, adapter, headers):
+    """Reuses one authorized client, and with it its OAuth token and pooled
+    connections, per host and client ID until it is `client_ttl` seconds old."""
+    key = (host, client_id)
+
+    with CLIENTS_LOCK:
+        client, created_at = CLIENTS.get(key, (None, 0))
+
+        if client is None or time.monotonic() - created_at > client_ttl:
+            client = PowerSchool(host=host, auth=(client_id, client_secret))
+
+            client.session.headers.update(headers)
+            client.session.mount("https://", adapter)
+            client.session.mount("http://", adapter)
+
+            CLIENTS[key] = (client, time.monotonic())
+
+        return client
 
 
 @resource(
@@ -7,15 +317,40 @@ from powerschool import PowerSchool
         "host": StringSource,
         "client_id": StringSource,
         "client_secret": StringSource,
+        "max_concurrency": Field(Int, is_required=False, default_value=16),
+        "min_concurrency": Field(Int, is_required=False, default_value=1),
+        "max_requests_per_second": Field(Float, is_required=False, default_value=0),
+        "pool_connections": Field(Int, is_required=False, default_value=10),
+        "pool_maxsize": Field(Int, is_required=False, default_value=16),
+        "keep_alive": Field(Bool, is_required=False, default_value=True),
+        "compress": Field(Bool, is_required=False, default_value=True),
+        "client_ttl": Field(Int, is_required=False, default_value=3000),
     }
 )
 def powerschool(init_context):
-    credentials = (
-        init_context.resource_config["client_id"],
-        init_context.resource_config["client_secret"],
+    config = init_context.resource_config
+
+    adapter = DeadlineHTTPAdapter(
+        rate_limiter=get_rate_limiter(
+            host=config["host"],
+            max_concurrency=config["max_concurrency"],
+            min_concurrency=config["min_concurrency"],
+            max_rate=config["max_requests_per_second"],
+        ),
+        pool_connections=config["pool_connections"],
+        pool_maxsize=config["pool_maxsize"],
     )
-    client = PowerSchool(
-        host=init_context.resource_config["host"],
-        auth=credentials,
+
+    headers = {
+        "Accept-Encoding": "gzip, deflate" if config["compress"] else "identity",
+        "Connection": "keep-alive" if config["keep_alive"] else "close",
+    }
+
+    return get_client(
+        host=config["host"],
+        client_id=config["client_id"],
+        client_secret=config["client_secret"],
+        client_ttl=config["client_ttl"],
+        adapter=adapter,
+        headers=headers,
     )
-    return client
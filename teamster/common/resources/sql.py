@@ -1,18 +1,63 @@
+import decimal
 import json
+import threading
 
-from dagster import Field, IntSource, StringSource, resource
+import pyarrow as pa
+from dagster import Bool, Field, IntSource, Permissive, StringSource, resource
 from dagster.utils.merger import merge_dicts
 from sqlalchemy import text
 from sqlalchemy.engine import URL, create_engine
 
-from teamster.common.utils import CustomJSONEncoder
+from teamster.common.utils import json_dumps
+
+ENGINES = {}
+ENGINES_LOCK = threading.Lock()
+
+
+def get_engine(url, **engine_options):
+    """Reuses one engine, and with it its connection pool, per connection URL and
+    engine options for the life of the process."""
+    key = (
+        url.render_as_string(hide_password=False),
+        json.dumps(engine_options, sort_keys=True, default=str),
+    )
+
+    with ENGINES_LOCK:
+        if key not in ENGINES:
+            ENGINES[key] = create_engine(url=url, **engine_options)
+
+        return ENGINES[key]
+
+
+def get_cursor_arrow_type(description):
+    """Arrow type declared by a DBAPI cursor description entry, or None to infer
+    it from the values.
+
+    Only decimals are declared: inferred per batch, their scale follows the
+    values, so 1.5 would be padded to 1.500 once a later batch holds 2.125.
+    """
+    _, type_code, _, _, precision, scale, _ = description
+    if type_code is decimal.Decimal and precision and scale is not None:
+        if precision <= 38:
+            return pa.decimal128(precision, scale)
+        else:
+            return pa.decimal256(precision, scale)
+    else:
+        return None
+
+
+def to_record_batch(rows, columns, arrow_types):
+    return pa.RecordBatch.from_arrays(
+        [pa.array(values, type=t) for values, t in zip(zip(*rows), arrow_types)],
+        names=columns,
+    )
 
 
 class SqlAlchemyEngine(object):
-    def __init__(self, dialect, driver, logger, **kwargs):
+    def __init__(self, dialect, driver, logger, engine_options=None, **kwargs):
         self.log = logger
         self.connection_url = URL.create(drivername=f"{dialect}+{driver}", **kwargs)
-        self.engine = create_engine(url=self.connection_url)
+        self.engine = get_engine(url=self.connection_url, **(engine_options or {}))
 
     def execute_text_query(self, query, output="dict"):
         self.log.info(f"Executing query:\n{query}")
@@ -27,10 +72,73 @@ class SqlAlchemyEngine(object):
 
         self.log.info(f"Retrieved {len(output_obj)} rows.")
         if output == "json":
-            return json.dumps(obj=output_obj, cls=CustomJSONEncoder)
+            return json_dumps(output_obj).decode("utf-8")
         else:
             return output_obj
 
+    def stream_text_query(self, query, batch_size=10000):
+        """Yields the result as lists of at most `batch_size` row dicts.
+
+        Rows are read through a server-side cursor, so memory use is bounded by
+        one batch rather than the whole result.
+        """
+        self.log.info(f"Streaming query:\n{query}")
+
+        n_rows = 0
+        with self.engine.connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(
+                statement=text(query)
+            )
+
+            mappings = result.mappings()
+            while True:
+                rows = mappings.fetchmany(batch_size)
+                if not rows:
+                    break
+
+                n_rows += len(rows)
+                yield [dict(row) for row in rows]
+
+        self.log.info(f"Retrieved {n_rows} rows.")
+
+    def execute_arrow_query(self, query, batch_size=10000):
+        """Returns the result as a pyarrow Table, built from record batches of at
+        most `batch_size` rows read through a server-side cursor.
+
+        Decimal columns take the precision and scale from the cursor
+        description. Other column types are inferred per batch and promoted to
+        one type per column across batches, e.g. int64 and double become double,
+        and a column that is all null in the first batch takes the type of the
+        first batch with values.
+        """
+        self.log.info(f"Executing query:\n{query}")
+
+        tables = []
+        with self.engine.connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(
+                statement=text(query)
+            )
+            columns = list(result.keys())
+            arrow_types = [get_cursor_arrow_type(d) for d in result.cursor.description]
+
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+
+                batch = to_record_batch(
+                    rows=rows, columns=columns, arrow_types=arrow_types
+                )
+                tables.append(pa.Table.from_batches([batch]))
+
+        if tables:
+            table = pa.concat_tables(tables, promote_options="permissive")
+        else:
+            table = pa.table({c: pa.array([], type=pa.null()) for c in columns})
+
+        self.log.info(f"Retrieved {table.num_rows} rows.")
+        return table
+
 
 class MssqlEngine(SqlAlchemyEngine):
     def __init__(self, dialect, driver, logger, mssql_driver, **kwargs):
@@ -39,6 +147,15 @@ class MssqlEngine(SqlAlchemyEngine):
         )
 
 
+ENGINE_OPTIONS = [
+    "pool_size",
+    "max_overflow",
+    "pool_pre_ping",
+    "pool_recycle",
+    "connect_args",
+]
+
+
 SQLALCHEMY_ENGINE_CONFIG = {
     "dialect": Field(StringSource),
     "driver": Field(StringSource),
@@ -47,14 +164,33 @@ SQLALCHEMY_ENGINE_CONFIG = {
     "host": Field(StringSource, is_required=False),
     "port": Field(IntSource, is_required=False),
     "database": Field(StringSource, is_required=False),
+    "pool_size": Field(IntSource, is_required=False, default_value=5),
+    "max_overflow": Field(IntSource, is_required=False, default_value=10),
+    "pool_pre_ping": Field(Bool, is_required=False, default_value=True),
+    "pool_recycle": Field(IntSource, is_required=False, default_value=1800),
+    "connect_args": Field(Permissive({}), is_required=False, default_value={}),
 }
 
 
+def split_engine_config(config):
+    """Splits resource config into URL parts and `create_engine` options."""
+    config = dict(config)
+    engine_options = {k: config.pop(k) for k in ENGINE_OPTIONS if k in config}
+
+    return config, engine_options
+
+
 @resource(
     config_schema=merge_dicts(
         SQLALCHEMY_ENGINE_CONFIG,
-        {"mssql_driver": Field(StringSource, is_required=False)},
+        {
+            "mssql_driver": Field(StringSource, is_required=False),
+            "fast_executemany": Field(Bool, is_required=False, default_value=False),
+        },
     )
 )
 def mssql(context):
-    return MssqlEngine(logger=context.log, **context.resource_config)
+    config, engine_options = split_engine_config(context.resource_config)
+    engine_options["fast_executemany"] = config.pop("fast_executemany")
+
+    return MssqlEngine(logger=context.log, engine_options=engine_options, **config)
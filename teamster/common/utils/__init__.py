@@ -1,12 +1,15 @@
+import contextvars
 import datetime
 import decimal
 import json
 import os
-import signal
+import queue
+import threading
+import time
 from contextlib import contextmanager
 from zoneinfo import ZoneInfo
 
-from dagster.core.storage.pipeline_run import DagsterRunStatus, RunsFilter
+import orjson
 
 LOCAL_TIME_ZONE = ZoneInfo(os.getenv("LOCAL_TIME_ZONE"))
 TODAY = datetime.datetime.now(tz=LOCAL_TIME_ZONE)
@@ -23,54 +26,146 @@ class CustomJSONEncoder(json.JSONEncoder):
             return super().default(o)
 
 
+def json_default(o):
+    if isinstance(o, (datetime.timedelta, decimal.Decimal)):
+        return str(o)
+    elif isinstance(o, (datetime.datetime, datetime.date)):
+        return o.isoformat()
+    else:
+        raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+def json_dumps(obj):
+    """Serializes `obj` to UTF-8 JSON bytes with orjson, encoding the same types
+    the same way as `CustomJSONEncoder`.
+
+    Falls back to `json.dumps` for values orjson rejects, e.g. integers wider
+    than 64 bits.
+    """
+    try:
+        return orjson.dumps(obj, default=json_default, option=orjson.OPT_NON_STR_KEYS)
+    except orjson.JSONEncodeError:
+        return json.dumps(obj=obj, cls=CustomJSONEncoder).encode("utf-8")
+
+
+DEADLINE = contextvars.ContextVar("deadline", default=None)
+
+
 @contextmanager
 def time_limit(seconds):
-    def signal_handler(signum, frame):
-        raise TimeoutError(f"Timed out after {seconds}")
+    """Sets a deadline for the enclosed block.
 
-    signal.signal(signal.SIGALRM, signal_handler)
-    signal.alarm(seconds)
+    The deadline is stored in a context variable, so it is scoped to the calling
+    thread or asyncio task and nested limits can only shorten it. Blocking calls
+    enforce it by asking for `remaining_time()`.
+    """
+    deadline = time.monotonic() + seconds
+
+    current_deadline = DEADLINE.get()
+    if current_deadline is not None:
+        deadline = min(deadline, current_deadline)
+
+    token = DEADLINE.set(deadline)
     try:
         yield
     finally:
-        signal.alarm(0)
-
-
-def get_last_schedule_run(context):
-    schedule_name = context.get_tag(key="dagster/schedule_name")
-    if schedule_name:
-        runs = context.instance.get_run_records(
-            filters=RunsFilter(
-                statuses=[DagsterRunStatus.SUCCESS],
-                job_name=context.job_name,
-                tags={"dagster/schedule_name": schedule_name},
-            ),
-            limit=1,
-        )
-
-        if "resync" not in context.job_name:
-            ix = context.job_name.index("_")
-            repo_name = context.job_name[:ix]
-            resyncs = context.instance.get_run_records(
-                filters=RunsFilter(
-                    statuses=[DagsterRunStatus.SUCCESS],
-                    job_name=f"{repo_name}_resync",
-                ),
-                limit=1,
-            )
+        DEADLINE.reset(token)
 
-        last_run = runs[0] if runs else None
-        last_resync = resyncs[0] if resyncs else None
-        if last_run:
-            return last_run.create_timestamp.astimezone(tz=LOCAL_TIME_ZONE)
-        elif last_resync:
-            return last_resync.create_timestamp.astimezone(tz=LOCAL_TIME_ZONE)
-        else:
-            return None
-            # # return UNIX Epoch if schedule or resync never ran
-            # return datetime(1970, 1, 1, tzinfo=timezone.utc).astimezone(
-            #     tz=LOCAL_TIME_ZONE
-            # )
-    else:
-        # pass if ad hoc query
+
+def remaining_time():
+    deadline = DEADLINE.get()
+    if deadline is None:
         return None
+
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError("Deadline exceeded")
+    else:
+        return remaining
+
+
+PIPELINE_DONE = object()
+
+
+def run_pipeline(items, stages, queue_size=1):
+    """Streams `items` through `stages`, a list of (function, n_workers) tuples.
+
+    Each stage runs on its own worker threads and is connected to the next by a
+    queue holding at most `queue_size` items, so stages overlap while memory is
+    bounded. Returns the output of the last stage in the order of `items`. The
+    first exception raised by any stage stops the pipeline and is re-raised.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    stop = threading.Event()
+    errors = []
+    results = {}
+
+    def _put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return PIPELINE_DONE
+
+    def _worker(ix, func, workers_left, lock):
+        in_q = queues[ix]
+        out_q = queues[ix + 1] if ix + 1 < len(queues) else None
+
+        while True:
+            item = _get(in_q)
+            if item is PIPELINE_DONE:
+                # let sibling workers see the sentinel too
+                _put(in_q, PIPELINE_DONE)
+                break
+
+            i, value = item
+            try:
+                value = func(value)
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+                break
+
+            if out_q is None:
+                results[i] = value
+            else:
+                _put(out_q, (i, value))
+
+        with lock:
+            workers_left[0] -= 1
+            if workers_left[0] == 0 and out_q is not None:
+                _put(out_q, PIPELINE_DONE)
+
+    threads = []
+    for ix, (func, n_workers) in enumerate(stages):
+        workers_left = [n_workers]
+        lock = threading.Lock()
+        for _ in range(n_workers):
+            thread = threading.Thread(
+                target=_worker, args=(ix, func, workers_left, lock), daemon=True
+            )
+            thread.start()
+            threads.append(thread)
+
+    for i, value in enumerate(items):
+        if stop.is_set():
+            break
+        _put(queues[0], (i, value))
+    _put(queues[0], PIPELINE_DONE)
+
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+    return [results[i] for i in sorted(results)]
@@ -0,0 +1,5 @@
+import os
+
+# read at import time by teamster.common.utils and teamster.common.ops
+os.environ.setdefault("LOCAL_TIME_ZONE", "America/New_York")
+os.environ.setdefault("POWERSCHOOL_YEAR_ID", "32")
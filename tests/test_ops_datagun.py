@@ -0,0 +1,216 @@
+import datetime
+import decimal
+import io
+
+import pyarrow as pa
+import pytest
+from dagster import Failure, build_op_context
+
+from teamster.common.ops import datagun
+from teamster.common.ops.datagun import (
+    arrow_to_gsheet,
+    encode_batches,
+    extract_batch,
+    to_gsheet,
+    write_arrow,
+    write_batches,
+)
+from teamster.common.resources.sql import to_record_batch
+
+UTC = datetime.timezone.utc
+
+BATCHES = [
+    [
+        {
+            "id": 1,
+            "score": 1.0,
+            "gpa": decimal.Decimal("3.50"),
+            "active": True,
+            "name": "Ada",
+            "dob": datetime.date(2010, 1, 2),
+            "updated": datetime.datetime(2022, 7, 1, 8, 30),
+            "synced": datetime.datetime(2022, 7, 1, 8, 30, tzinfo=UTC),
+            "due": datetime.datetime(2022, 7, 1),
+            "starts": datetime.time(8, 30),
+            "elapsed": datetime.timedelta(days=1, seconds=5),
+        },
+        {
+            "id": None,
+            "score": 1e-05,
+            "gpa": None,
+            "active": None,
+            "name": None,
+            "dob": None,
+            "updated": None,
+            "synced": None,
+            "due": None,
+            "starts": None,
+            "elapsed": None,
+        },
+    ],
+    [
+        {
+            "id": 3,
+            "score": 3e15,
+            "gpa": decimal.Decimal("2.25"),
+            "active": False,
+            "name": "Grace",
+            "dob": datetime.date(2011, 3, 4),
+            "updated": datetime.datetime(2022, 7, 2, 9, 0),
+            "synced": datetime.datetime(2022, 7, 2, 9, 0, 1, 500000, tzinfo=UTC),
+            "due": datetime.datetime(2022, 7, 2),
+            "starts": datetime.time(9, 0, 1, 500),
+            "elapsed": datetime.timedelta(minutes=90),
+        },
+        {
+            "id": 4,
+            "score": None,
+            "gpa": decimal.Decimal("4.00"),
+            "active": True,
+            "name": "Edsger",
+            "dob": datetime.date(2012, 5, 6),
+            "updated": datetime.datetime(2022, 7, 3, 10, 15, 30),
+            "synced": datetime.datetime(2022, 7, 3, 10, 15, 30, tzinfo=UTC),
+            "due": datetime.datetime(2022, 7, 3),
+            "starts": datetime.time(10, 15),
+            "elapsed": datetime.timedelta(0),
+        },
+    ],
+]
+
+
+def test_encode_batches_pins_csv_dtypes_across_batches():
+    batches = [
+        [{"id": 1, "gpa": 3.5, "active": True, "note": None}],
+        [
+            {"id": None, "gpa": None, "active": None, "note": 3},
+            {"id": 5, "gpa": 4.0, "active": False, "note": None},
+        ],
+    ]
+
+    csv = b"".join(encode_batches(batches=batches, file_suffix="csv", file_format={}))
+
+    assert csv.decode("utf-8").splitlines() == [
+        "id,gpa,active,note",
+        "1,3.5,True,",
+        ",,,3",
+        "5,4.0,False,",
+    ]
+
+
+def test_encode_batches_json():
+    batches = [[{"id": 1}, {"id": 2}], [{"id": 3}]]
+
+    json_bytes = b"".join(
+        encode_batches(batches=batches, file_suffix="json", file_format={})
+    )
+
+    assert json_bytes == b'[{"id":1},{"id":2},{"id":3}]'
+
+
+def to_arrow_table(batches):
+    """Builds the table `execute_arrow_query` would from the same cursor
+    batches, with `gpa` declared as a NUMERIC(3, 2) column."""
+    columns = list(batches[0][0])
+    arrow_types = [pa.decimal128(3, 2) if c == "gpa" else None for c in columns]
+
+    return pa.concat_tables(
+        [
+            pa.Table.from_batches(
+                [
+                    to_record_batch(
+                        rows=[tuple(row.values()) for row in batch],
+                        columns=columns,
+                        arrow_types=arrow_types,
+                    )
+                ]
+            )
+            for batch in batches
+        ],
+        promote_options="permissive",
+    )
+
+
+@pytest.mark.parametrize(
+    "names,file_format",
+    [
+        (["Ada", "Grace", "Edsger"], {}),
+        (["Ada", "Grace", "Edsger"], {"sep": "\t"}),
+        # values that need quoting
+        (["Lovelace, Ada", 'Grace "Amazing" Hopper', "Edsger"], {}),
+        (["Ada", "Grace", "Edsger"], {"sep": "\t", "header": False}),
+    ],
+)
+def test_write_arrow_csv_matches_python_engine(names, file_format):
+    batches = [[dict(row) for row in batch] for batch in BATCHES]
+    for row, name in zip([r for b in batches for r in b if r["name"]], names):
+        row["name"] = name
+
+    python_csv = io.BytesIO()
+    write_batches(
+        fileobj=python_csv, batches=batches, file_suffix="csv", file_format=file_format
+    )
+
+    arrow_csv = io.BytesIO()
+    write_arrow(
+        fileobj=arrow_csv,
+        table=to_arrow_table(batches),
+        file_suffix="csv",
+        file_format=file_format,
+        batch_size=2,
+    )
+
+    assert arrow_csv.getvalue().decode("utf-8") == python_csv.getvalue().decode("utf-8")
+
+
+def test_write_arrow_csv_single_column_with_nulls_matches_python_engine():
+    batches = [[{"id": 1}, {"id": None}], [{"id": 3}]]
+
+    python_csv = io.BytesIO()
+    write_batches(
+        fileobj=python_csv, batches=batches, file_suffix="csv", file_format={}
+    )
+
+    arrow_csv = io.BytesIO()
+    write_arrow(
+        fileobj=arrow_csv,
+        table=to_arrow_table(batches),
+        file_suffix="csv",
+        file_format={},
+        batch_size=2,
+    )
+
+    assert arrow_csv.getvalue() == python_csv.getvalue() == b'id\n1\n""\n3\n'
+
+
+def test_arrow_to_gsheet_matches_to_gsheet():
+    data = [row for batch in BATCHES for row in batch]
+
+    assert arrow_to_gsheet(to_arrow_table(BATCHES)) == to_gsheet(data)
+
+
+def test_extract_batch_yields_successful_exports_before_failing(monkeypatch):
+    def export_query(context, dynamic_query):
+        query, file_config, _ = dynamic_query
+        if query == "bad":
+            raise RuntimeError("query failed")
+        return ("sftp", (query, "/")), {}
+
+    monkeypatch.setattr(datagun, "export_query", export_query)
+    dynamic_queries = [
+        (query, {"stem": stem}, {})
+        for query, stem in [("a", "gpa"), ("bad", "roster"), ("c", "grades")]
+    ]
+
+    outputs = []
+    with pytest.raises(Failure, match="1 of 3 queries failed to export: roster_1"):
+        for output in extract_batch(
+            build_op_context(resources={"db": None, "file_manager": None}),
+            dynamic_queries,
+        ):
+            outputs.append(output)
+
+    assert [(o.mapping_key, o.value) for o in outputs] == [
+        ("gpa_0", ("sftp", ("a", "/"))),
+        ("grades_2", ("sftp", ("c", "/"))),
+    ]
@@ -0,0 +1,492 @@
+import asyncio
+import io
+import logging
+import re
+from types import SimpleNamespace
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from dagster import RetryPolicy, RetryRequested
+from powerschool import PowerSchool
+from requests import HTTPError, Response
+from requests.adapters import BaseAdapter
+from requests.exceptions import ConnectionError
+
+from teamster.common.ops import powerschool
+from teamster.common.ops.powerschool import (
+    compact_query_files,
+    extract_pages_async,
+    fetch_page_async,
+    filter_queries_outputs,
+    generate_adaptive_queries,
+    get_arrow_type,
+    get_table_schema,
+    is_retryable,
+    records_to_parquet,
+    unify_page_schemas,
+)
+
+
+class StatusAdapter(BaseAdapter):
+    """Answers every request with one status code and a JSON error body."""
+
+    def __init__(self, status_code):
+        super().__init__()
+        self.status_code = status_code
+
+    def send(self, request, **kwargs):
+        response = Response()
+        response.status_code = self.status_code
+        response.url = request.url
+        response.request = request
+        response._content = b'{"message":"Invalid query"}'
+        return response
+
+    def close(self):
+        pass
+
+
+def client_error(status_code):
+    """The exception the PowerSchool client raises for an HTTP error status."""
+    client = PowerSchool(host="powerschool.test")
+    client.session.mount("https://", StatusAdapter(status_code))
+
+    try:
+        client.get_schema_table("students").count(q="id=ge=1")
+    except HTTPError as e:
+        return e
+
+
+@pytest.mark.parametrize("status_code", [408, 429, 500, 502, 503, 504])
+def test_is_retryable_transient_http_errors(status_code):
+    assert is_retryable(client_error(status_code))
+
+
+@pytest.mark.parametrize("status_code", [400, 401, 403, 404, 422])
+def test_is_retryable_client_errors(status_code):
+    e = client_error(status_code)
+
+    # the client drops the response from the exception it raises
+    assert e.response is None
+    assert not is_retryable(e)
+
+
+@pytest.mark.parametrize(
+    "e",
+    [
+        HTTPError("no response"),
+        TimeoutError("Deadline exceeded"),
+        ConnectionError("Connection reset"),
+        ValueError("unclassified"),
+    ],
+)
+def test_is_retryable_other_errors(e):
+    assert is_retryable(e)
+
+
+@pytest.fixture
+def count_ids(monkeypatch):
+    """Answers range counts from a list of record ids."""
+    counts = []
+
+    def _count(ids):
+        def _time_limit_count(context, table, query, count_type):
+            lo = int(re.search(r"id=ge=(\d+)", query).group(1))
+            hi = re.search(r"id=lt=(\d+)", query)
+            hi = int(hi.group(1)) if hi else None
+
+            counts.append(query)
+            return len([i for i in ids if i >= lo and (hi is None or i < hi)])
+
+        monkeypatch.setattr(powerschool, "time_limit_count", _time_limit_count)
+        return counts
+
+    return _count
+
+
+def make_context(target_pages, page_size):
+    context = SimpleNamespace(
+        op_config={"target_pages": target_pages, "max_workers": 4},
+        log=logging.getLogger(__name__),
+    )
+    table = SimpleNamespace(
+        client=SimpleNamespace(
+            metadata=SimpleNamespace(schema_table_query_max_page_size=page_size)
+        )
+    )
+    return context, table
+
+
+def parse_range(query):
+    lo = int(re.search(r"id=ge=(\d+)", query).group(1))
+    hi = re.search(r"id=lt=(\d+)", query)
+    return lo, int(hi.group(1)) if hi else None
+
+
+def test_generate_adaptive_queries_covers_range(count_ids):
+    ids = list(range(1, 1001))
+    count_ids(ids)
+    context, table = make_context(target_pages=2, page_size=100)
+
+    queries = generate_adaptive_queries(
+        context=context, table=table, selector="id", min_value=1, max_value=1000
+    )
+    ranges = [parse_range(q) for q in queries]
+
+    # contiguous, starting at the minimum and open-ended at the end
+    assert ranges[0][0] == 1
+    assert ranges[-1][1] is None
+    for (_, hi), (lo, _) in zip(ranges, ranges[1:]):
+        assert hi == lo
+
+    # every partition fits the target
+    for lo, hi in ranges:
+        assert len([i for i in ids if i >= lo and (hi is None or i < hi)]) <= 200
+
+
+def test_generate_adaptive_queries_merges_sparse_ranges(count_ids):
+    # dense at the start, then a long empty gap and a few stragglers
+    ids = list(range(1, 401)) + [100000, 500000, 999999]
+    count_ids(ids)
+    context, table = make_context(target_pages=1, page_size=100)
+
+    queries = generate_adaptive_queries(
+        context=context, table=table, selector="id", min_value=1, max_value=999999
+    )
+
+    ranges = [parse_range(q) for q in queries]
+
+    # the empty gap and the stragglers share the last partition with dense ids
+    assert ranges[-1][0] <= 400
+    assert ranges[-1][1] is None
+    assert len(queries) <= 7
+
+
+def test_generate_adaptive_queries_single_partition(count_ids):
+    counts = count_ids(list(range(1, 51)))
+    context, table = make_context(target_pages=1, page_size=100)
+
+    queries = generate_adaptive_queries(
+        context=context, table=table, selector="id", min_value=1, max_value=50
+    )
+
+    assert queries == ["id=ge=1"]
+    assert len(counts) == 1
+
+
+@pytest.mark.parametrize(
+    "column,arrow_type",
+    [
+        ({"type": "NUMBER(10)"}, pa.int64()),
+        ({"type": "NUMBER(10,0)"}, pa.int64()),
+        ({"type": "NUMBER", "scale": 0}, pa.int64()),
+        ({"type": "INTEGER"}, pa.int64()),
+        ({"type": "NUMBER(10,2)"}, pa.float64()),
+        ({"type": "NUMBER"}, pa.float64()),
+        ({"type": "FLOAT"}, pa.float64()),
+        ({"type": "TIMESTAMP"}, pa.timestamp("s")),
+        ({"type": "DATE"}, pa.date32()),
+        ({"type": "VARCHAR2(40)"}, pa.string()),
+        ({}, pa.string()),
+    ],
+)
+def test_get_arrow_type(column, arrow_type):
+    assert get_arrow_type(column) == arrow_type
+
+
+def read_parquet(records, schema):
+    context = SimpleNamespace(log=logging.getLogger(__name__))
+    return pq.read_table(
+        io.BytesIO(
+            records_to_parquet(
+                context=context, records=records, table_name="t", schema=schema
+            )
+        )
+    )
+
+
+def test_records_to_parquet_keeps_schema_across_pages():
+    schema = [("id", pa.int64()), ("gpa", pa.float64()), ("name", pa.string())]
+
+    clean = read_parquet(
+        records=[{"tables": {"t": {"id": "1", "gpa": "3.5", "name": "a"}}}],
+        schema=schema,
+    )
+    dirty = read_parquet(
+        records=[
+            {"tables": {"t": {"id": 2, "gpa": "n/a", "name": 7}}},
+            {"tables": {"t": {"id": "3.0", "gpa": 4}}},
+        ],
+        schema=schema,
+    )
+
+    assert clean.schema == dirty.schema
+    assert dirty.to_pydict() == {
+        "id": [2, 3],
+        "gpa": [None, 4.0],
+        "name": ["7", None],
+    }
+
+
+def test_records_to_parquet_keeps_unknown_columns_as_strings():
+    table = read_parquet(
+        records=[{"id": "1", "extra": {"a": 1}}], schema=[("id", pa.int64())]
+    )
+
+    assert table.schema.field("extra").type == pa.string()
+    assert table.column("extra").to_pylist() == ['{"a":1}']
+
+
+def test_unify_page_schemas():
+    schema = unify_page_schemas(
+        [
+            pa.schema([("id", pa.int64()), ("a", pa.string())]),
+            pa.schema([("id", pa.float64()), ("b", pa.bool_())]),
+            pa.schema([("a", pa.int64())]),
+        ]
+    )
+
+    assert schema == pa.schema(
+        [("id", pa.float64()), ("a", pa.string()), ("b", pa.bool_())]
+    )
+
+
+def watermarks_by_query(queries, high_water_marks):
+    watermarks = {}
+    for output in filter_queries_outputs(
+        table_queries=[(32, "students", None, queries, high_water_marks)]
+    ):
+        if output.output_name == "dynamic_tables":
+            _, _, q, _, watermark = output.value
+            watermarks[q] = watermark
+        elif output.output_name == "table_queries":
+            for _, _, _, _, selector, value, watermark in output.value:
+                watermarks[f"{selector}={value}"] = watermark
+    return watermarks
+
+
+def test_high_water_marks_follow_queries_not_positions():
+    queries = [
+        {"q": "schoolid==133570965"},
+        {"q": {"selector": "id", "value": 1000}},
+        {"q": "enroll_status==0"},
+    ]
+    high_water_marks = {
+        "|schoolid==133570965": "2022-07-01T00:00:00+00:00",
+        "|id=1000": "2022-07-02T00:00:00+00:00",
+        "|enroll_status==0": "2022-07-03T00:00:00+00:00",
+    }
+
+    watermarks = watermarks_by_query(queries, high_water_marks)
+
+    assert watermarks == watermarks_by_query(queries[::-1], high_water_marks)
+    assert watermarks["enroll_status==0"] == (
+        "|enroll_status==0",
+        "2022-07-03T00:00:00+00:00",
+    )
+    assert watermarks["id=1000"] == ("|id=1000", "2022-07-02T00:00:00+00:00")
+
+
+class FakeFileManager:
+    """Objects in a dict; `compose` raises once `fail_on` composes have run."""
+
+    _gcs_bucket = "bucket"
+
+    def __init__(self, objects, fail_on=None):
+        self.objects = dict(objects)
+        self.fail_on = fail_on
+        self.n_composes = 0
+
+    def get_full_key(self, file_key):
+        return f"teamster/{file_key}"
+
+    def _list_sizes(self, prefix):
+        return {k: len(v) for k, v in self.objects.items() if k.startswith(prefix)}
+
+    def _rm_keys(self, keys):
+        for key in keys:
+            del self.objects[key]
+
+    def compose(self, source_keys, file_key):
+        self.n_composes += 1
+        if self.n_composes == self.fail_on:
+            raise ConnectionError("compose failed")
+
+        self.objects[file_key] = b"".join(self.objects[k] for k in source_keys)
+        return powerschool.GCSFileHandle(self._gcs_bucket, self.get_full_key(file_key))
+
+
+def compact(file_manager):
+    context = SimpleNamespace(
+        log=logging.getLogger(__name__),
+        op_config={"target_size": 2},
+        resources=SimpleNamespace(file_manager=file_manager),
+    )
+    return compact_query_files(context=context, stem="students", suffix="jsonl.gz")
+
+
+def test_compact_query_files_rerun_after_failure_keeps_every_page():
+    pages = {f"students_p_{n}.jsonl.gz": b"%d" % n for n in range(4)}
+    file_manager = FakeFileManager(objects=pages, fail_on=2)
+
+    with pytest.raises(ConnectionError):
+        compact(file_manager)
+
+    file_manager.fail_on = None
+    file_handles = compact(file_manager)
+
+    assert file_manager.objects == {
+        "students_c_0_1.jsonl.gz": b"01",
+        "students_c_2_3.jsonl.gz": b"23",
+    }
+    assert [fh.gcs_key for fh in file_handles] == [
+        "teamster/students_c_0_1.jsonl.gz",
+        "teamster/students_c_2_3.jsonl.gz",
+    ]
+
+
+def test_compact_query_files_new_extract_replaces_compacted_objects():
+    file_manager = FakeFileManager(
+        objects={
+            "students_c_0_1.jsonl.gz": b"ab",
+            "students_c_2_3.jsonl.gz": b"cd",
+            "students_p_0.jsonl.gz": b"0",
+            "students_p_1.jsonl.gz": b"1",
+        }
+    )
+
+    compact(file_manager)
+
+    assert file_manager.objects == {"students_c_0_1.jsonl.gz": b"01"}
+
+
+def test_get_table_schema_caches_only_fetched_schemas(monkeypatch):
+    monkeypatch.setattr(powerschool, "TABLE_SCHEMAS", {})
+    context = SimpleNamespace(op_config={"query_timeout": 30})
+    responses = [
+        ConnectionError("metadata failed"),
+        {"columns": [{"name": "ID", "type": "NUMBER(10)"}]},
+    ]
+
+    def metadata():
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    table = SimpleNamespace(name="students", metadata=metadata)
+
+    with pytest.raises(ConnectionError):
+        get_table_schema(context=context, table=table, projection="ID")
+
+    assert get_table_schema(context=context, table=table, projection="ID") == [
+        ("id", pa.int64())
+    ]
+    assert get_table_schema(context=context, table=table, projection="*") == [
+        ("id", pa.int64())
+    ]
+
+
+class SlowClient:
+    """`AsyncPowerSchool` stand-in whose first `n_slow` queries never answer."""
+
+    def __init__(self, n_slow):
+        self.n_slow = n_slow
+        self.n_cancelled = 0
+
+    async def query(self, table_name, q, projection, page):
+        if self.n_slow:
+            self.n_slow -= 1
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                self.n_cancelled += 1
+                raise
+        return [{"id": page}]
+
+
+def make_async_context(page_retries, **kwargs):
+    return SimpleNamespace(
+        log=logging.getLogger(__name__),
+        op_config={
+            "query_timeout": 0.05,
+            "page_retries": page_retries,
+            "page_retry_delay": 0,
+            "page_retry_max_delay": 0,
+            "max_workers": 2,
+            "skip_unchanged": False,
+            **kwargs,
+        },
+        op_def=SimpleNamespace(retry_policy=RetryPolicy(max_retries=5, delay=30)),
+    )
+
+
+def test_fetch_page_async_cancels_slow_requests():
+    client = SlowClient(n_slow=1)
+
+    records = asyncio.run(
+        fetch_page_async(
+            context=make_async_context(page_retries=1),
+            client=client,
+            table_name="students",
+            projection=None,
+            query=None,
+            page=0,
+            n_pages=1,
+        )
+    )
+
+    assert records == [{"id": 1}]
+    assert client.n_cancelled == 1
+
+
+def test_fetch_page_async_retries_the_step_after_page_retries():
+    client = SlowClient(n_slow=2)
+
+    with pytest.raises(RetryRequested):
+        asyncio.run(
+            fetch_page_async(
+                context=make_async_context(page_retries=1),
+                client=client,
+                table_name="students",
+                projection=None,
+                query=None,
+                page=0,
+                n_pages=1,
+            )
+        )
+
+    assert client.n_cancelled == 2
+
+
+def test_extract_pages_async_returns_uploads_in_page_order(monkeypatch):
+    uploaded = {}
+
+    class FileManager:
+        async def upload_async(self, storage, obj, file_key, skip_unchanged):
+            uploaded[file_key] = obj
+            return file_key, False
+
+    monkeypatch.setattr(
+        powerschool, "AsyncPowerSchool", lambda client, session: SlowClient(n_slow=0)
+    )
+    monkeypatch.setattr(powerschool, "Storage", lambda session: None)
+
+    context = make_async_context(page_retries=0)
+    context.resources = SimpleNamespace(file_manager=FileManager())
+
+    uploads = asyncio.run(
+        extract_pages_async(
+            context=context,
+            table=SimpleNamespace(name="students", client=None),
+            projection="id",
+            query=None,
+            pages=[(p, f"students_p_{p}.json") for p in range(5)],
+            n_pages=5,
+            serialize=lambda key_data: (key_data[0], repr(key_data[1])),
+        )
+    )
+
+    assert uploads == [(f"students_p_{p}.json", 0) for p in range(5)]
+    assert uploaded["students_p_3.json"] == "[{'id': 4}]"
@@ -0,0 +1,166 @@
+import asyncio
+from types import SimpleNamespace
+
+import aiohttp
+import pytest
+from aiohttp import web
+from requests.exceptions import HTTPError
+
+from teamster.common.ops.powerschool import get_status_code, is_retryable
+from teamster.common.resources import powerschool
+from teamster.common.resources.powerschool import (
+    AdaptiveRateLimiter,
+    AsyncPowerSchool,
+)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(powerschool.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_healthy_responses_raise_limits_additively(clock):
+    limiter = AdaptiveRateLimiter(max_concurrency=16, max_rate=10.0)
+    limiter.concurrency = 4.0
+    limiter.rate = 4.0
+
+    for _ in range(4):
+        limiter.release(healthy=True, sent_at=limiter.acquire())
+        clock[0] += 1
+
+    assert limiter.concurrency == pytest.approx(5.0, abs=0.1)
+    assert limiter.rate == pytest.approx(5.0, abs=0.1)
+
+
+def test_limits_never_exceed_maximum(clock):
+    limiter = AdaptiveRateLimiter(max_concurrency=4)
+
+    for _ in range(10):
+        limiter.release(healthy=True, sent_at=limiter.acquire())
+
+    assert limiter.concurrency == 4
+
+
+def test_unhealthy_response_halves_limits(clock):
+    limiter = AdaptiveRateLimiter(max_concurrency=16, max_rate=8.0)
+
+    limiter.release(healthy=False, sent_at=limiter.acquire())
+
+    assert limiter.concurrency == 8
+    assert limiter.rate == 4
+
+
+def test_limits_decrease_once_per_round_trip(clock):
+    limiter = AdaptiveRateLimiter(max_concurrency=16)
+
+    # a burst of failures from requests that were all in flight together
+    sent_at = [limiter.acquire() for _ in range(8)]
+    clock[0] += 0.5
+    for s in sent_at:
+        limiter.release(healthy=False, sent_at=s)
+
+    assert limiter.concurrency == 8
+
+    # a request sent after the decrease saw the new limit and counts again
+    clock[0] += 0.5
+    sent_at = limiter.acquire()
+    clock[0] += 0.5
+    limiter.release(healthy=False, sent_at=sent_at)
+
+    assert limiter.concurrency == 4
+
+
+def test_limits_respect_minimum(clock):
+    limiter = AdaptiveRateLimiter(max_concurrency=4, min_concurrency=2)
+
+    for _ in range(4):
+        sent_at = limiter.acquire()
+        clock[0] += 1
+        limiter.release(healthy=False, sent_at=sent_at)
+
+    assert limiter.concurrency == 2
+
+
+def test_retry_after_pauses_callers(clock):
+    limiter = AdaptiveRateLimiter(max_concurrency=4)
+
+    limiter.release(healthy=False, retry_after=30, sent_at=limiter.acquire())
+
+    assert limiter._wait_time(clock[0]) == 30
+    assert limiter._wait_time(clock[0] + 30) == 0
+
+
+def test_wait_time_blocks_at_concurrency_limit(clock):
+    limiter = AdaptiveRateLimiter(max_concurrency=2)
+
+    limiter.acquire()
+    limiter.acquire()
+
+    assert limiter._wait_time(clock[0]) is None
+
+
+def test_wait_time_waits_for_tokens(clock):
+    limiter = AdaptiveRateLimiter(max_concurrency=4, max_rate=2.0)
+
+    limiter.acquire()
+
+    assert limiter._wait_time(clock[0]) == pytest.approx(0.5)
+
+
+async def query_server(handler, **kwargs):
+    """Runs `AsyncPowerSchool.query(**kwargs)` against `handler` served on a
+    local port, with a host rate limiter."""
+    app = web.Application()
+    app.router.add_get("/ws/schema/table/{table_name}", handler)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    client = SimpleNamespace(
+        host=f"127.0.0.1:{port}",
+        base_url=f"http://127.0.0.1:{port}",
+        session=SimpleNamespace(headers={"Authorization": "Bearer token"}),
+        metadata=SimpleNamespace(schema_table_query_max_page_size=2),
+    )
+    limiter = powerschool.get_rate_limiter(host=client.host, max_concurrency=4)
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            async_client = AsyncPowerSchool(client=client, session=session)
+            return await async_client.query(**kwargs)
+    finally:
+        assert limiter.in_flight == 0
+        await runner.cleanup()
+
+
+def test_async_query_unwraps_records():
+    async def handler(request):
+        assert request.headers["Authorization"] == "Bearer token"
+        assert dict(request.query) == {"q": "id=ge=1", "page": "2", "pagesize": "2"}
+
+        return web.json_response(
+            {"record": [{"tables": {"students": {"id": "3"}}}, {"tables": {}}]}
+        )
+
+    records = asyncio.run(
+        query_server(handler, table_name="students", q="id=ge=1", page=2)
+    )
+
+    assert records == [{"id": "3"}, None]
+
+
+@pytest.mark.parametrize("status_code,retryable", [(400, False), (503, True)])
+def test_async_query_raises_http_errors_like_the_client(status_code, retryable):
+    async def handler(request):
+        return web.json_response({"message": "Invalid query"}, status=status_code)
+
+    with pytest.raises(HTTPError, match="Invalid query") as excinfo:
+        asyncio.run(query_server(handler, table_name="students", page=1))
+
+    assert get_status_code(excinfo.value) == status_code
+    assert is_retryable(excinfo.value) == retryable
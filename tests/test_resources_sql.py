@@ -0,0 +1,39 @@
+import decimal
+import logging
+
+import pyarrow as pa
+
+from teamster.common.resources.sql import SqlAlchemyEngine, get_cursor_arrow_type
+
+
+def test_execute_arrow_query_promotes_types_across_batches():
+    engine = SqlAlchemyEngine(
+        dialect="sqlite",
+        driver="pysqlite",
+        logger=logging.getLogger(__name__),
+        database=":memory:",
+    )
+
+    table = engine.execute_arrow_query(
+        query=(
+            "SELECT NULL AS a, 1 AS b UNION ALL "
+            "SELECT 'x' AS a, 2.5 AS b UNION ALL "
+            "SELECT 'y' AS a, 3 AS b"
+        ),
+        batch_size=1,
+    )
+
+    assert table.schema == pa.schema([("a", pa.string()), ("b", pa.float64())])
+    assert table.to_pydict() == {"a": [None, "x", "y"], "b": [1.0, 2.5, 3.0]}
+
+
+def test_get_cursor_arrow_type_declares_decimals():
+    assert get_cursor_arrow_type(
+        ("gpa", decimal.Decimal, None, 5, 5, 2, True)
+    ) == pa.decimal128(5, 2)
+    assert get_cursor_arrow_type(
+        ("n", decimal.Decimal, None, 40, 40, 10, True)
+    ) == pa.decimal256(40, 10)
+    assert get_cursor_arrow_type(("id", int, None, 10, 10, 0, True)) is None
+    # sqlite declares nothing
+    assert get_cursor_arrow_type(("x", None, None, None, None, None, None)) is None
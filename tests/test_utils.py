@@ -0,0 +1,67 @@
+import threading
+import time
+
+import pytest
+
+from teamster.common.utils import run_pipeline
+
+
+def test_run_pipeline_chains_stages_in_order():
+    def _slow_double(x):
+        # finish out of order
+        time.sleep(0.01 * (x % 3))
+        return x * 2
+
+    results = run_pipeline(
+        items=range(20), stages=[(_slow_double, 4), (str, 2)], queue_size=2
+    )
+
+    assert results == [str(x * 2) for x in range(20)]
+
+
+def test_run_pipeline_empty_items():
+    assert run_pipeline(items=[], stages=[(str, 2)]) == []
+
+
+def test_run_pipeline_raises_first_error():
+    def _fail_on_five(x):
+        if x == 5:
+            raise ValueError("five")
+        return x
+
+    with pytest.raises(ValueError, match="five"):
+        run_pipeline(items=range(100), stages=[(_fail_on_five, 2), (str, 1)])
+
+
+def test_run_pipeline_bounds_items_in_flight():
+    in_flight = []
+    lock = threading.Lock()
+    release = threading.Event()
+
+    def _produce(x):
+        with lock:
+            in_flight.append(x)
+        return x
+
+    def _consume(x):
+        release.wait(timeout=1)
+        return x
+
+    thread = threading.Thread(
+        target=run_pipeline,
+        kwargs={
+            "items": range(50),
+            "stages": [(_produce, 1), (_consume, 1)],
+            "queue_size": 1,
+        },
+    )
+    thread.start()
+    time.sleep(0.3)
+
+    # one item being consumed, one queued between stages, one being produced,
+    # and one waiting to be queued
+    assert len(in_flight) <= 4
+
+    release.set()
+    thread.join(timeout=5)
+    assert len(in_flight) == 50